@@ -4,6 +4,9 @@
 # See http://linuxfr.org/users/illwieckz/journaux/pyalsacap-python-pointeurs-et-cartes-sons
 # See alsa source seq.h, seqmid.h, control.h, aconnect.c
 import logging
+import select
+import threading
+import time
 
 from ctypes import *
 
@@ -11,96 +14,410 @@ from ctypes import *
 SND_SEQ_OPEN_OUTPUT = 1  # define SND_SEQ_OPEN_OUTPUT    1    /**< open for output (write) */
 SND_SEQ_OPEN_INPUT = 2  # define SND_SEQ_OPEN_INPUT    2    /**< open for input (read) */
 SND_SEQ_OPEN_DUPLEX = SND_SEQ_OPEN_OUTPUT | SND_SEQ_OPEN_INPUT  # define SND_SEQ_OPEN_DUPLEX    (SND_SEQ_OPEN_OUTPUT|SND_SEQ_OPEN_INPUT)    /**< open for both input and output (read/write) */
+SND_SEQ_NONBLOCK = 1  # define SND_SEQ_NONBLOCK    0x0001    /**< non-blocking mode (flag to open mode) */
+SND_SEQ_PORT_CAP_READ = 1 << 0  # define SND_SEQ_PORT_CAP_READ    (1<<0)    /**< readable from this port */
+SND_SEQ_PORT_CAP_WRITE = 1 << 1  # define SND_SEQ_PORT_CAP_WRITE    (1<<1)    /**< writable to this port */
+SND_SEQ_PORT_CAP_SUBS_READ = 1 << 5  # define SND_SEQ_PORT_CAP_SUBS_READ    (1<<5)    /**< allow read subscription */
+SND_SEQ_PORT_CAP_SUBS_WRITE = 1 << 6  # define SND_SEQ_PORT_CAP_SUBS_WRITE    (1<<6)    /**< allow write subscription */
+SND_SEQ_PORT_CAP_NO_EXPORT = 1 << 7  # define SND_SEQ_PORT_CAP_NO_EXPORT    (1<<7)    /**< routing not allowed */
+SND_SEQ_PORT_TYPE_MIDI_GENERIC = 1 << 1  # define SND_SEQ_PORT_TYPE_MIDI_GENERIC    (1<<1)    /**< generic MIDI device */
+SND_SEQ_PORT_TYPE_APPLICATION = 1 << 20  # define SND_SEQ_PORT_TYPE_APPLICATION    (1<<20)    /**< application (sequencer/editor) */
+# from seq_event.h
+SND_SEQ_CLIENT_SYSTEM = 0  # define SND_SEQ_CLIENT_SYSTEM    0    /**< system client */
+SND_SEQ_PORT_SYSTEM_ANNOUNCE = 1  # define SND_SEQ_PORT_SYSTEM_ANNOUNCE    1    /**< system announce port */
+SND_SEQ_TIME_STAMP_REAL = 1 << 0  # define SND_SEQ_TIME_STAMP_REAL    (1<<0)    /**< timestamp in real time */
+SND_SEQ_EVENT_LENGTH_VARIABLE = 1 << 2  # define SND_SEQ_EVENT_LENGTH_VARIABLE    (1<<2)    /**< variable event size */
+SND_SEQ_QUEUE_DIRECT = 253  # define SND_SEQ_QUEUE_DIRECT    253    /**< direct dispatch */
+SND_SEQ_ADDRESS_UNKNOWN = 253  # define SND_SEQ_ADDRESS_UNKNOWN    253    /**< unknown source */
+SND_SEQ_ADDRESS_SUBSCRIBERS = 254  # define SND_SEQ_ADDRESS_SUBSCRIBERS    254    /**< send event to all subscribed ports */
+SND_SEQ_EVENT_NOTEON = 6
+SND_SEQ_EVENT_NOTEOFF = 7
+SND_SEQ_EVENT_CONTROLLER = 10
+SND_SEQ_EVENT_PGMCHANGE = 11
+SND_SEQ_EVENT_START = 30
+SND_SEQ_EVENT_CLIENT_START = 60
+SND_SEQ_EVENT_CLIENT_EXIT = 61
+SND_SEQ_EVENT_CLIENT_CHANGE = 62
+SND_SEQ_EVENT_PORT_START = 63
+SND_SEQ_EVENT_PORT_EXIT = 64
+SND_SEQ_EVENT_PORT_CHANGE = 65
+SND_SEQ_EVENT_SYSEX = 130
+# from poll.h
+POLLIN = 1
 
 
-def aconnect(from_port, to_port):
-    libasound = cdll.LoadLibrary("libasound.so.2")
-
-    seq = c_void_p()  # snd_seq_t *seq;
-    queue = c_int(0)
-    convert_time = c_int(0)
-    convert_real = c_int(0)
-    exclusive = c_int(0)
-    # list_perm = c_int(0)  # int list_perm = 0;
-    client = c_int()  # int client;
-    list_subs = c_int(0)  # int list_subs = 0;
-    subs = c_void_p()  # snd_seq_port_subscribe_t *subs;
-    # snd_seq_addr_t sender, dest;
-    sender = c_void_p()
-    dest = c_void_p()
+class snd_seq_addr_t(Structure):
+    # typedef struct snd_seq_addr { unsigned char client; unsigned char port; } snd_seq_addr_t;
+    _fields_ = [("client", c_ubyte), ("port", c_ubyte)]
 
-    # int snd_seq_open(snd_seq_t **handle, const char *name, int streams, int mode);
-    # if (snd_seq_open(&seq, "default", SND_SEQ_OPEN_DUPLEX, 0) < 0) {
-    if (libasound.snd_seq_open(byref(seq), b"default", SND_SEQ_OPEN_DUPLEX, 0) < 0):
-        logging.error("can't open sequencer\n")
-        return(1)
-    # print(seq, seq.value)  # Looks ok
 
-    # int snd_seq_client_id(snd_seq_t *handle);
-    # if ((client = snd_seq_client_id(seq)) < 0) {
-    client = libasound.snd_seq_client_id(seq)
-    if (client < 0):
-        libasound.snd_seq_close(seq)
-        logging.error("can't get client id")
-        return(1)
+class snd_seq_ev_note_t(Structure):
+    _fields_ = [("channel", c_ubyte), ("note", c_ubyte), ("velocity", c_ubyte),
+                ("off_velocity", c_ubyte), ("duration", c_uint)]
+
+
+class snd_seq_ev_ctrl_t(Structure):
+    _fields_ = [("channel", c_ubyte), ("unused", c_ubyte * 3), ("param", c_uint), ("value", c_int)]
+
+
+class snd_seq_ev_ext_t(Structure):
+    # struct snd_seq_ev_ext { unsigned int len; void *ptr; } __attribute__((packed));
+    _pack_ = 1
+    _fields_ = [("len", c_uint), ("ptr", c_void_p)]
+
+
+class snd_seq_connect_t(Structure):
+    _fields_ = [("sender", snd_seq_addr_t), ("dest", snd_seq_addr_t)]
+
+
+class snd_seq_event_data_t(Union):
+    _fields_ = [("note", snd_seq_ev_note_t), ("control", snd_seq_ev_ctrl_t), ("raw8", c_ubyte * 12),
+                ("ext", snd_seq_ev_ext_t), ("addr", snd_seq_addr_t), ("connect", snd_seq_connect_t)]
 
-    # set client info
-    # if (snd_seq_set_client_name(seq, "ALSA Connector") < 0) {
-    if (libasound.snd_seq_set_client_name(seq, b"ALSA Connector") < 0):
-        libasound.snd_seq_close(seq)
-        logging.error("can't set client info")
-        return(1)
 
-    # set subscription
-    # Example use of original aconnect:
-    # aconnect 14:0 16:32
+class snd_seq_real_time_t(Structure):
+    _fields_ = [("tv_sec", c_uint), ("tv_nsec", c_uint)]
+
+
+class snd_seq_timestamp_t(Union):
+    _fields_ = [("tick", c_uint), ("time", snd_seq_real_time_t)]
+
+
+class snd_seq_event_t(Structure):
+    _fields_ = [("type", c_ubyte), ("flags", c_ubyte), ("tag", c_ubyte), ("queue", c_ubyte),
+                ("time", snd_seq_timestamp_t), ("source", snd_seq_addr_t), ("dest", snd_seq_addr_t),
+                ("data", snd_seq_event_data_t)]
+
+
+class pollfd(Structure):
+    _fields_ = [("fd", c_int), ("events", c_short), ("revents", c_short)]
+
+
+class SequencerError(Exception):
+    pass
+
+
+_libasound = None
+
+
+def load_libasound():
+    """Charge libasound une seule fois et déclare les prototypes utilisés"""
+    global _libasound
+    if _libasound is not None:
+        return _libasound
+    lib = cdll.LoadLibrary("libasound.so.2")
+    # int snd_seq_open(snd_seq_t **handle, const char *name, int streams, int mode);
+    lib.snd_seq_open.argtypes = [POINTER(c_void_p), c_char_p, c_int, c_int]
+    lib.snd_seq_open.restype = c_int
+    # int snd_seq_close(snd_seq_t *handle);
+    lib.snd_seq_close.argtypes = [c_void_p]
+    lib.snd_seq_close.restype = c_int
+    # int snd_seq_client_id(snd_seq_t *handle);
+    lib.snd_seq_client_id.argtypes = [c_void_p]
+    lib.snd_seq_client_id.restype = c_int
+    # int snd_seq_set_client_name(snd_seq_t *seq, const char *name);
+    lib.snd_seq_set_client_name.argtypes = [c_void_p, c_char_p]
+    lib.snd_seq_set_client_name.restype = c_int
     # in seqmid.h:
     # int snd_seq_parse_address(snd_seq_t *seq, snd_seq_addr_t *addr, const char *str);
-    # if (snd_seq_parse_address(seq, &sender, argv[optind]) < 0) {
-    # if (libasound.snd_seq_parse_address(seq, byref(sender), b"14:0") < 0):  # ok
-    if (libasound.snd_seq_parse_address(seq, byref(sender), from_port) < 0):
-        libasound.snd_seq_close(seq)
-        logging.error("invalid sender address %s", from_port)
-        return(1)
-    # if (snd_seq_subscribe_port(seq, subs) < 0) {
-
-    # if (snd_seq_parse_address(seq, &dest, argv[optind + 1]) < 0) {
-    # if (libasound.snd_seq_parse_address(seq, byref(dest), b"16:32") < 0):
-    if (libasound.snd_seq_parse_address(seq, byref(dest), to_port) < 0):
-        # Also ok with aeolus:In
-        libasound.snd_seq_close(seq)
-        logging.error("invalid destination address %s", to_port)
-        return(1)
-
-    # define snd_seq_port_subscribe_alloca(ptr) \
-    #    __snd_alloca(ptr, snd_seq_port_subscribe)
+    lib.snd_seq_parse_address.argtypes = [c_void_p, POINTER(snd_seq_addr_t), c_char_p]
+    lib.snd_seq_parse_address.restype = c_int
     # int snd_seq_port_subscribe_malloc(snd_seq_port_subscribe_t **ptr);
-    # define __snd_alloca(ptr,type) do { *ptr = (type##_t *) alloca(type##_sizeof()); memset(*ptr, 0, type##_sizeof()); } while (0)
-    # size_t snd_seq_port_subscribe_sizeof(void);
-    # print(libasound.snd_seq_port_subscribe_sizeof()) # --> 80
-    subs = (c_void_p * int(libasound.snd_seq_port_subscribe_sizeof() / sizeof(c_void_p)))()
-    # snd_seq_port_subscribe_alloca(&subs);
-
-    libasound.snd_seq_port_subscribe_set_sender(subs, byref(sender))
-    libasound.snd_seq_port_subscribe_set_dest(subs, byref(dest))
-    libasound.snd_seq_port_subscribe_set_queue(subs, queue)
-    libasound.snd_seq_port_subscribe_set_exclusive(subs, exclusive)
-    libasound.snd_seq_port_subscribe_set_time_update(subs, convert_time)
-    libasound.snd_seq_port_subscribe_set_time_real(subs, convert_real)
-
-    # if (snd_seq_get_port_subscription(seq, subs) == 0) {
-    if (libasound.snd_seq_get_port_subscription(seq, subs) == 0):
-        libasound.snd_seq_close(seq)
-        logging.error("Connection from %s to %s is already subscribed", from_port, to_port)
-        return(2)
-
-    # if (snd_seq_subscribe_port(seq, subs) < 0) {
-    if (libasound.snd_seq_subscribe_port(seq, subs) < 0):
-        libasound.snd_seq_close(seq)
-        logging.error("Connection from %s to %s failed", from_port, to_port)
-        return(1)
+    lib.snd_seq_port_subscribe_malloc.argtypes = [POINTER(c_void_p)]
+    lib.snd_seq_port_subscribe_malloc.restype = c_int
+    # void snd_seq_port_subscribe_free(snd_seq_port_subscribe_t *ptr);
+    lib.snd_seq_port_subscribe_free.argtypes = [c_void_p]
+    lib.snd_seq_port_subscribe_free.restype = None
+    # void snd_seq_port_subscribe_set_sender(snd_seq_port_subscribe_t *info, const snd_seq_addr_t *addr);
+    # void snd_seq_port_subscribe_set_dest(snd_seq_port_subscribe_t *info, const snd_seq_addr_t *addr);
+    for f in (lib.snd_seq_port_subscribe_set_sender, lib.snd_seq_port_subscribe_set_dest):
+        f.argtypes = [c_void_p, POINTER(snd_seq_addr_t)]
+        f.restype = None
+    # void snd_seq_port_subscribe_set_queue(snd_seq_port_subscribe_t *info, int q);
+    # void snd_seq_port_subscribe_set_exclusive(snd_seq_port_subscribe_t *info, int val);
+    # void snd_seq_port_subscribe_set_time_update(snd_seq_port_subscribe_t *info, int val);
+    # void snd_seq_port_subscribe_set_time_real(snd_seq_port_subscribe_t *info, int val);
+    for f in (lib.snd_seq_port_subscribe_set_queue, lib.snd_seq_port_subscribe_set_exclusive,
+              lib.snd_seq_port_subscribe_set_time_update, lib.snd_seq_port_subscribe_set_time_real):
+        f.argtypes = [c_void_p, c_int]
+        f.restype = None
+    # int snd_seq_get_port_subscription(snd_seq_t *handle, snd_seq_port_subscribe_t *sub);
+    # int snd_seq_subscribe_port(snd_seq_t *handle, snd_seq_port_subscribe_t *sub);
+    # int snd_seq_unsubscribe_port(snd_seq_t *handle, snd_seq_port_subscribe_t *sub);
+    for f in (lib.snd_seq_get_port_subscription, lib.snd_seq_subscribe_port, lib.snd_seq_unsubscribe_port):
+        f.argtypes = [c_void_p, c_void_p]
+        f.restype = c_int
+    # int snd_seq_nonblock(snd_seq_t *handle, int nonblock);
+    lib.snd_seq_nonblock.argtypes = [c_void_p, c_int]
+    lib.snd_seq_nonblock.restype = c_int
+    # int snd_seq_create_simple_port(snd_seq_t *seq, const char *name, unsigned int caps, unsigned int type);
+    lib.snd_seq_create_simple_port.argtypes = [c_void_p, c_char_p, c_uint, c_uint]
+    lib.snd_seq_create_simple_port.restype = c_int
+    # int snd_seq_connect_from(snd_seq_t *seq, int my_port, int src_client, int src_port);
+    # int snd_seq_connect_to(snd_seq_t *seq, int my_port, int dest_client, int dest_port);
+    for f in (lib.snd_seq_connect_from, lib.snd_seq_connect_to):
+        f.argtypes = [c_void_p, c_int, c_int, c_int]
+        f.restype = c_int
+    # int snd_seq_poll_descriptors_count(snd_seq_t *handle, short events);
+    lib.snd_seq_poll_descriptors_count.argtypes = [c_void_p, c_short]
+    lib.snd_seq_poll_descriptors_count.restype = c_int
+    # int snd_seq_poll_descriptors(snd_seq_t *handle, struct pollfd *pfds, unsigned int space, short events);
+    lib.snd_seq_poll_descriptors.argtypes = [c_void_p, POINTER(pollfd), c_uint, c_short]
+    lib.snd_seq_poll_descriptors.restype = c_int
+    # int snd_seq_event_input(snd_seq_t *handle, snd_seq_event_t **ev);
+    lib.snd_seq_event_input.argtypes = [c_void_p, POINTER(POINTER(snd_seq_event_t))]
+    lib.snd_seq_event_input.restype = c_int
+    # int snd_seq_port_info_malloc(snd_seq_port_info_t **ptr);
+    lib.snd_seq_port_info_malloc.argtypes = [POINTER(c_void_p)]
+    lib.snd_seq_port_info_malloc.restype = c_int
+    # void snd_seq_port_info_free(snd_seq_port_info_t *ptr);
+    lib.snd_seq_port_info_free.argtypes = [c_void_p]
+    lib.snd_seq_port_info_free.restype = None
+    # int snd_seq_get_any_port_info(snd_seq_t *handle, int client, int port, snd_seq_port_info_t *info);
+    lib.snd_seq_get_any_port_info.argtypes = [c_void_p, c_int, c_int, c_void_p]
+    lib.snd_seq_get_any_port_info.restype = c_int
+    # void snd_seq_port_info_set_name(snd_seq_port_info_t *info, const char *name);
+    lib.snd_seq_port_info_set_name.argtypes = [c_void_p, c_char_p]
+    lib.snd_seq_port_info_set_name.restype = None
+    # void snd_seq_port_info_set_capability(snd_seq_port_info_t *info, unsigned int capability);
+    # void snd_seq_port_info_set_type(snd_seq_port_info_t *info, unsigned int type);
+    for f in (lib.snd_seq_port_info_set_capability, lib.snd_seq_port_info_set_type):
+        f.argtypes = [c_void_p, c_uint]
+        f.restype = None
+    # void snd_seq_port_info_set_timestamping(snd_seq_port_info_t *info, int enable);
+    # void snd_seq_port_info_set_timestamp_real(snd_seq_port_info_t *info, int realtime);
+    # void snd_seq_port_info_set_timestamp_queue(snd_seq_port_info_t *info, int queue);
+    for f in (lib.snd_seq_port_info_set_timestamping, lib.snd_seq_port_info_set_timestamp_real,
+              lib.snd_seq_port_info_set_timestamp_queue):
+        f.argtypes = [c_void_p, c_int]
+        f.restype = None
+    # int snd_seq_port_info_get_port(const snd_seq_port_info_t *info);
+    lib.snd_seq_port_info_get_port.argtypes = [c_void_p]
+    lib.snd_seq_port_info_get_port.restype = c_int
+    # int snd_seq_create_port(snd_seq_t *handle, snd_seq_port_info_t *info);
+    lib.snd_seq_create_port.argtypes = [c_void_p, c_void_p]
+    lib.snd_seq_create_port.restype = c_int
+    # int snd_seq_alloc_named_queue(snd_seq_t *seq, const char *name);
+    lib.snd_seq_alloc_named_queue.argtypes = [c_void_p, c_char_p]
+    lib.snd_seq_alloc_named_queue.restype = c_int
+    # int snd_seq_free_queue(snd_seq_t *handle, int q);
+    lib.snd_seq_free_queue.argtypes = [c_void_p, c_int]
+    lib.snd_seq_free_queue.restype = c_int
+    # int snd_seq_control_queue(snd_seq_t *seq, int q, int type, int value, snd_seq_event_t *ev);
+    lib.snd_seq_control_queue.argtypes = [c_void_p, c_int, c_int, c_int, POINTER(snd_seq_event_t)]
+    lib.snd_seq_control_queue.restype = c_int
+    # int snd_seq_drain_output(snd_seq_t *handle);
+    lib.snd_seq_drain_output.argtypes = [c_void_p]
+    lib.snd_seq_drain_output.restype = c_int
+    # int snd_seq_event_output_direct(snd_seq_t *handle, snd_seq_event_t *ev);
+    lib.snd_seq_event_output_direct.argtypes = [c_void_p, POINTER(snd_seq_event_t)]
+    lib.snd_seq_event_output_direct.restype = c_int
+    _libasound = lib
+    return lib
+
+
+class SequencerSession(object):
+    """Client du séquenceur ALSA ouvert une fois pour plusieurs connexions"""
+    def __init__(self, client_name=b"ALSA Connector"):
+        self.lib = load_libasound()
+        self.seq = c_void_p()  # snd_seq_t *seq;
+        self.subs = c_void_p()  # snd_seq_port_subscribe_t *subs;
+        self.port_info = None
+        self.announce_port = None
+        # if (snd_seq_open(&seq, "default", SND_SEQ_OPEN_DUPLEX, 0) < 0) {
+        if (self.lib.snd_seq_open(byref(self.seq), b"default", SND_SEQ_OPEN_DUPLEX, 0) < 0):
+            self.seq = None
+            raise SequencerError("can't open sequencer")
+        # if ((client = snd_seq_client_id(seq)) < 0) {
+        self.client = self.lib.snd_seq_client_id(self.seq)
+        if (self.client < 0):
+            self.close()
+            raise SequencerError("can't get client id")
+        # set client info
+        # if (snd_seq_set_client_name(seq, "ALSA Connector") < 0) {
+        if (self.lib.snd_seq_set_client_name(self.seq, client_name) < 0):
+            self.close()
+            raise SequencerError("can't set client info")
+        # Une seule structure d'abonnement, réutilisée à chaque connexion
+        if (self.lib.snd_seq_port_subscribe_malloc(byref(self.subs)) < 0):
+            self.subs = None
+            self.close()
+            raise SequencerError("can't allocate subscription")
+
+    def close(self):
+        if self.port_info:
+            self.lib.snd_seq_port_info_free(self.port_info)
+            self.port_info = None
+        if self.subs:
+            self.lib.snd_seq_port_subscribe_free(self.subs)
+            self.subs = None
+        if self.seq:
+            self.lib.snd_seq_close(self.seq)
+            self.seq = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def parse_address(self, name):
+        """Adresse client:port à partir d'un nom ou de numéros (b"aeolus:In", b"14:0")"""
+        addr = snd_seq_addr_t()
+        if (self.lib.snd_seq_parse_address(self.seq, byref(addr), name) < 0):
+            return None
+        return addr
+
+    def port_exists(self, name):
+        """Vrai si le client existe et possède le port demandé"""
+        addr = self.parse_address(name)
+        if addr is None:
+            return False
+        if not self.port_info:
+            self.port_info = c_void_p()
+            if (self.lib.snd_seq_port_info_malloc(byref(self.port_info)) < 0):
+                self.port_info = None
+                raise SequencerError("can't allocate port info")
+        return self.lib.snd_seq_get_any_port_info(self.seq, addr.client, addr.port, self.port_info) == 0
+
+    def watch_announce(self):
+        """Abonne la session au port d'annonce du système (0:1)"""
+        if self.announce_port is not None:
+            return
+        port = self.lib.snd_seq_create_simple_port(
+            self.seq, b"announce",
+            SND_SEQ_PORT_CAP_WRITE | SND_SEQ_PORT_CAP_NO_EXPORT, SND_SEQ_PORT_TYPE_APPLICATION)
+        if (port < 0):
+            raise SequencerError("can't create announce port")
+        if (self.lib.snd_seq_connect_from(self.seq, port, SND_SEQ_CLIENT_SYSTEM, SND_SEQ_PORT_SYSTEM_ANNOUNCE) < 0):
+            raise SequencerError("can't subscribe to announce port")
+        self.lib.snd_seq_nonblock(self.seq, 1)
+        self.announce_port = port
+
+    def poll_descriptors(self):
+        count = self.lib.snd_seq_poll_descriptors_count(self.seq, POLLIN)
+        pfds = (pollfd * count)()
+        count = self.lib.snd_seq_poll_descriptors(self.seq, pfds, count, POLLIN)
+        return [pfds[i].fd for i in range(count)]
+
+    def read_events(self):
+        """Événements en attente (mode non bloquant), sous forme (type, client, port)"""
+        ev = POINTER(snd_seq_event_t)()
+        events = []
+        while self.lib.snd_seq_event_input(self.seq, byref(ev)) >= 0:
+            e = ev.contents
+            # L'événement appartient à libasound: on en copie le contenu utile
+            events.append((e.type, e.data.addr.client, e.data.addr.port))
+        return events
 
-    return(0)
+    def wait_for_ports(self, names, timeout):
+        """Attend que tous les ports existent, renvoie le délai ou None si timeout"""
+        start = time.monotonic()
+        # Abonnement avant la vérification: aucune annonce ne peut être manquée
+        self.watch_announce()
+        poller = select.poll()
+        for fd in self.poll_descriptors():
+            poller.register(fd, select.POLLIN)
+        while True:
+            if all(self.port_exists(name) for name in names):
+                return time.monotonic() - start
+            remaining = timeout - (time.monotonic() - start)
+            if remaining <= 0:
+                return None
+            if poller.poll(remaining * 1000):
+                self.read_events()
+
+    def _subscription(self, from_port, to_port):
+        # Example use of original aconnect:
+        # aconnect 14:0 16:32
+        sender = self.parse_address(from_port)
+        if sender is None:
+            logging.error("invalid sender address %s", from_port)
+            return None
+        dest = self.parse_address(to_port)
+        if dest is None:
+            # Also ok with aeolus:In
+            logging.error("invalid destination address %s", to_port)
+            return None
+        self.lib.snd_seq_port_subscribe_set_sender(self.subs, byref(sender))
+        self.lib.snd_seq_port_subscribe_set_dest(self.subs, byref(dest))
+        self.lib.snd_seq_port_subscribe_set_queue(self.subs, 0)
+        self.lib.snd_seq_port_subscribe_set_exclusive(self.subs, 0)
+        self.lib.snd_seq_port_subscribe_set_time_update(self.subs, 0)
+        self.lib.snd_seq_port_subscribe_set_time_real(self.subs, 0)
+        return self.subs
+
+    def is_connected(self, from_port, to_port):
+        subs = self._subscription(from_port, to_port)
+        # if (snd_seq_get_port_subscription(seq, subs) == 0) {
+        return subs is not None and self.lib.snd_seq_get_port_subscription(self.seq, subs) == 0
+
+    def connect(self, from_port, to_port):
+        """0 si connecté, 2 si déjà connecté, 1 en cas d'échec"""
+        subs = self._subscription(from_port, to_port)
+        if subs is None:
+            return(1)
+        if (self.lib.snd_seq_get_port_subscription(self.seq, subs) == 0):
+            logging.error("Connection from %s to %s is already subscribed", from_port, to_port)
+            return(2)
+        # if (snd_seq_subscribe_port(seq, subs) < 0) {
+        if (self.lib.snd_seq_subscribe_port(self.seq, subs) < 0):
+            logging.error("Connection from %s to %s failed", from_port, to_port)
+            return(1)
+        return(0)
+
+    def disconnect(self, from_port, to_port):
+        """0 si déconnecté, 1 en cas d'échec"""
+        subs = self._subscription(from_port, to_port)
+        if subs is None:
+            return(1)
+        # if (snd_seq_unsubscribe_port(seq, subs) < 0) {
+        if (self.lib.snd_seq_unsubscribe_port(self.seq, subs) < 0):
+            logging.error("Disconnection from %s to %s failed", from_port, to_port)
+            return(1)
+        return(0)
+
+
+class AnnounceWatcher(threading.Thread):
+    """Relaie les annonces ALSA de clients et de ports aux fonctions abonnées"""
+    def __init__(self, client_name=b"ALSA Announce"):
+        threading.Thread.__init__(self, name='AnnounceWatcher', daemon=True)
+        # Ouverture dans le thread appelant pour signaler les erreurs tout de suite
+        self.session = SequencerSession(client_name)
+        try:
+            self.session.watch_announce()
+        except SequencerError:
+            self.session.close()
+            raise
+        self.listeners = []
+        self.stopped = False
+
+    def add_listener(self, callback):
+        """callback(type, client, port), appelé depuis le thread de surveillance"""
+        self.listeners.append(callback)
+
+    def run(self):
+        poller = select.poll()
+        for fd in self.session.poll_descriptors():
+            poller.register(fd, select.POLLIN)
+        while not self.stopped:
+            if poller.poll(500):
+                for event in self.session.read_events():
+                    for callback in self.listeners:
+                        callback(*event)
+        self.session.close()
+
+    def stop(self):
+        self.stopped = True
+
+
+def aconnect(from_port, to_port):
+    try:
+        with SequencerSession() as seq:
+            return seq.connect(from_port, to_port)
+    except (OSError, SequencerError) as e:
+        logging.error("%s", e)
+        return(1)
 
 
 if __name__ == '__main__':
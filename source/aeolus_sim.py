@@ -0,0 +1,179 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# Aeolus simulé: côté orgue du protocole CC98/CC99 utilisé par le launchpad
+
+import time
+
+from bridge import (AEOLUS, AEOLUS_CC, AEOLUS_CC2, AEOLUS_DUMP_NOTE, CONTROL_CHANGE, DUMP_QUIET, LAUNCHPAD,
+                    LP_TOP_FIRST, MAX_GROUPS, MAX_STOPS, NOTE_ON, PRESET_HOLD, SYNC_RETRIES, BridgeEngine)
+
+
+class AeolusSimulator(object):
+    """Modélise la réponse d'Aeolus aux messages CC98 et à la note 23"""
+    def __init__(self, types=None, midi_channel=0):
+        # types[groupe][registre]: type d'élément du GUI (0 à 3)
+        if types is None:
+            types = [[group % 4] * MAX_STOPS for group in range(MAX_GROUPS)]
+        self.types = types
+        self.midi_channel = midi_channel
+        self.engaged = [0] * 8
+        self.mode = None
+        self.group = None
+        # Messages reçus mais pas encore traités (voir AeolusPort)
+        self.inbox = []
+        self.received = 0
+        self.sent = 0
+        # Durée de traitement de chaque message reçu, en secondes
+        self.latencies = []
+
+    def cc(self, controller, value):
+        return [CONTROL_CHANGE + self.midi_channel, controller, value]
+
+    def receive(self, message):
+        """Traite un message destiné à Aeolus et renvoie ses réponses"""
+        start = time.perf_counter()
+        self.received += 1
+        replies = []
+        if message[0] & 0xF0 == CONTROL_CHANGE and message[1] == AEOLUS_CC:
+            if message[2] & 0x40:
+                self.mode = (message[2] >> 4) & 0x03
+                self.group = message[2] & 0x07
+                if self.mode == 0:
+                    self.engaged[self.group] = 0
+                    replies.append(self.cc(AEOLUS_CC, message[2]))
+                    self.mode = None
+            elif self.mode is not None:
+                stop_number = message[2] & 0x1F
+                bit = 1 << stop_number
+                if self.mode == 1:
+                    self.engaged[self.group] &= ~bit
+                elif self.mode == 2:
+                    self.engaged[self.group] |= bit
+                else:
+                    self.engaged[self.group] ^= bit
+                # Aeolus renvoie le changement d'état effectif
+                mode = 2 if self.engaged[self.group] & bit else 1
+                replies.append(self.cc(AEOLUS_CC, 0x40 | (mode << 4) | self.group))
+                replies.append(self.cc(AEOLUS_CC, stop_number))
+        elif message[0] & 0xF0 == NOTE_ON and message[1] == AEOLUS_DUMP_NOTE:
+            replies = self.dump()
+        self.sent += len(replies)
+        self.latencies.append(time.perf_counter() - start)
+        return replies
+
+    def dump(self):
+        """État complet: types de tous les registres puis registres enclenchés"""
+        replies = []
+        for group, types in enumerate(self.types):
+            for stop_type in range(4):
+                stops = [n for n, t in enumerate(types) if t == stop_type]
+                if stops:
+                    replies.append(self.cc(AEOLUS_CC2, 0x40 | (stop_type << 4) | group))
+                    replies.extend(self.cc(AEOLUS_CC2, n) for n in stops)
+            replies.append(self.cc(AEOLUS_CC, 0x40 | group))
+            stops = [n for n in range(len(types)) if self.engaged[group] >> n & 1]
+            if stops:
+                replies.append(self.cc(AEOLUS_CC, 0x40 | (2 << 4) | group))
+                replies.extend(self.cc(AEOLUS_CC, n) for n in stops)
+        return replies
+
+    def pump(self):
+        """Traite les messages en attente et renvoie toutes les réponses"""
+        replies = []
+        while self.inbox:
+            inbox = self.inbox
+            self.inbox = []
+            for message in inbox:
+                replies.extend(self.receive(message))
+        return replies
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        n = len(latencies)
+        return {
+            'received': self.received,
+            'sent': self.sent,
+            'latency_mean_us': sum(latencies) / n * 1e6 if n else 0.0,
+            'latency_p50_us': latencies[n // 2] * 1e6 if n else 0.0,
+            'latency_max_us': latencies[-1] * 1e6 if n else 0.0,
+        }
+
+
+class AeolusPort(object):
+    """Port de sortie rtmidi en mémoire vers le simulateur (to_aeolus)"""
+    def __init__(self, simulator):
+        self.simulator = simulator
+
+    def send_message(self, message):
+        # Pas de traitement ici: le callback d'entrée ne doit pas être rappelé
+        # pendant qu'il s'exécute, les réponses sont livrées par pump()
+        self.simulator.inbox.append(list(message))
+
+
+def run_engine(engine, simulator, events, now=0.0):
+    """Injecte des événements dans le moteur et fait circuler les échanges
+    avec le simulateur jusqu'au silence; renvoie les messages pour le launchpad"""
+    to_launchpad = []
+    while True:
+        outgoing = engine.process_many(events)
+        to_launchpad.extend(outgoing[LAUNCHPAD])
+        simulator.inbox.extend(outgoing[AEOLUS])
+        if not simulator.inbox:
+            return to_launchpad
+        events = [(now, message, AEOLUS) for message in simulator.pump()]
+
+
+def self_test():
+    """Démarrage, synchronisation et inversion de registres sans matériel"""
+    simulator = AeolusSimulator()
+    simulator.engaged[0] = 0b101
+    engine = BridgeEngine()
+    # Comme main(): la note 23 est demandée au moteur, la fin de la réponse
+    # est constatée au premier tick après le silence d'Aeolus
+    engine.request_dump(0.0)
+    run_engine(engine, simulator, [])
+    engine.tick(DUMP_QUIET)
+    assert engine.sync.complete and not engine.hold_leds
+    assert engine.state.engaged[:MAX_GROUPS] == simulator.engaged[:MAX_GROUPS]
+    # Réponse tronquée: le dernier groupe manque, la note 23 repart
+    engine.request_dump(1.0)
+    simulator.inbox.extend(engine.flush()[AEOLUS])
+    dump = simulator.pump()
+    events = [(1.0, message, AEOLUS) for message in dump[:len(dump) * 3 // 4]]
+    engine.process_many(events)
+    engine.tick(1.5)
+    assert not engine.sync.complete and engine.sync.active
+    assert engine.flush()[AEOLUS] == [[NOTE_ON, AEOLUS_DUMP_NOTE, 127]]
+    simulator.inbox.append([NOTE_ON, AEOLUS_DUMP_NOTE, 127])
+    run_engine(engine, simulator, [], 1.5)
+    engine.tick(2.0)
+    assert engine.sync.complete and engine.sync.retries == 0
+    for note in (81, 82, 71, 11):
+        run_engine(engine, simulator, [(0.0, [NOTE_ON, note, 127], LAUNCHPAD)])
+    assert engine.state.engaged[:MAX_GROUPS] == simulator.engaged[:MAX_GROUPS]
+    # Mémorise sur le premier bouton du dessus, change un registre et rappelle
+    stored = simulator.engaged[:MAX_GROUPS]
+    run_engine(engine, simulator, [(1.0, [CONTROL_CHANGE, LP_TOP_FIRST, 127], LAUNCHPAD),
+                                   (1.0 + PRESET_HOLD, [CONTROL_CHANGE, LP_TOP_FIRST, 0], LAUNCHPAD)])
+    for note in (83, 12):
+        run_engine(engine, simulator, [(3.0, [NOTE_ON, note, 127], LAUNCHPAD)])
+    run_engine(engine, simulator, [(4.0, [CONTROL_CHANGE, LP_TOP_FIRST, 127], LAUNCHPAD),
+                                   (4.1, [CONTROL_CHANGE, LP_TOP_FIRST, 0], LAUNCHPAD)])
+    assert simulator.engaged[:MAX_GROUPS] == stored
+    assert engine.state.engaged[:MAX_GROUPS] == stored
+    # Réponse toujours fautive (registre après la remise à zéro du dernier
+    # groupe): la note 23 n'est redemandée que SYNC_RETRIES fois
+    faulty = AeolusSimulator()
+    dump = faulty.dump
+    faulty.dump = lambda: dump() + [faulty.cc(AEOLUS_CC, 0)]
+    faulty_engine = BridgeEngine()
+    faulty_engine.request_dump(0.0)
+    for n in range(20):
+        run_engine(faulty_engine, faulty, [], float(n))
+        faulty_engine.tick(n + 0.5)
+    assert faulty_engine.sync.requests == 1 + SYNC_RETRIES and not faulty_engine.sync.active
+    return simulator.stats()
+
+
+if __name__ == '__main__':
+    print(self_test())
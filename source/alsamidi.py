@@ -0,0 +1,225 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# Ports MIDI directement sur le séquenceur ALSA, sans rtmidi
+# Les événements du séquenceur sont décodés en messages MIDI pour le handler,
+# et les messages du handler encodés en événements envoyés sans queue
+import errno
+import logging
+import select
+import threading
+import time
+
+from ctypes import POINTER, addressof, byref, c_void_p, create_string_buffer
+
+from aconnect import (SND_SEQ_ADDRESS_SUBSCRIBERS, SND_SEQ_ADDRESS_UNKNOWN, SND_SEQ_EVENT_CONTROLLER,
+                      SND_SEQ_EVENT_LENGTH_VARIABLE, SND_SEQ_EVENT_NOTEOFF, SND_SEQ_EVENT_NOTEON,
+                      SND_SEQ_EVENT_PGMCHANGE, SND_SEQ_EVENT_START, SND_SEQ_EVENT_SYSEX, SND_SEQ_PORT_CAP_READ,
+                      SND_SEQ_PORT_CAP_SUBS_READ, SND_SEQ_PORT_CAP_SUBS_WRITE, SND_SEQ_PORT_CAP_WRITE,
+                      SND_SEQ_PORT_TYPE_APPLICATION, SND_SEQ_PORT_TYPE_MIDI_GENERIC, SND_SEQ_QUEUE_DIRECT,
+                      SND_SEQ_TIME_STAMP_REAL, SequencerError, SequencerSession, snd_seq_event_t)
+
+NOTE_OFF = 0x80
+NOTE_ON = 0x90
+CONTROL_CHANGE = 0xB0
+PROGRAM_CHANGE = 0xC0
+SYSTEM_EXCLUSIVE = 0xF0
+
+
+class AlsaSequencer(SequencerSession):
+    """Client séquenceur qui remplace les ports rtmidi: un port d'entrée
+    horodaté par une queue ALSA et des ports de sortie écrits directement"""
+    def __init__(self, client_name=b"lp2aeolus"):
+        SequencerSession.__init__(self, client_name)
+        self.queue = None
+        # Les sorties sont écrites depuis le thread MIDI et depuis main()
+        self.output_lock = threading.Lock()
+        self.input_event = POINTER(snd_seq_event_t)()
+        try:
+            self.queue = self.start_queue(client_name)
+            self.in_port = self.create_port(b"in", SND_SEQ_PORT_CAP_WRITE | SND_SEQ_PORT_CAP_SUBS_WRITE, self.queue)
+        except SequencerError:
+            self.close()
+            raise
+        self.lib.snd_seq_nonblock(self.seq, 1)
+
+    def close(self):
+        if self.seq and self.queue is not None:
+            self.lib.snd_seq_free_queue(self.seq, self.queue)
+            self.queue = None
+        SequencerSession.close(self)
+
+    def address(self, port):
+        """Adresse client:port d'un de nos ports, pour connect()"""
+        return b"%d:%d" % (self.client, port)
+
+    def start_queue(self, name):
+        queue = self.lib.snd_seq_alloc_named_queue(self.seq, name)
+        if (queue < 0):
+            raise SequencerError("can't allocate queue")
+        self.lib.snd_seq_control_queue(self.seq, queue, SND_SEQ_EVENT_START, 0, None)
+        self.lib.snd_seq_drain_output(self.seq)
+        return queue
+
+    def create_port(self, name, caps, timestamp_queue=None):
+        """Crée un port, horodaté en temps réel par la queue si elle est donnée"""
+        info = c_void_p()
+        if (self.lib.snd_seq_port_info_malloc(byref(info)) < 0):
+            raise SequencerError("can't allocate port info")
+        try:
+            self.lib.snd_seq_port_info_set_name(info, name)
+            self.lib.snd_seq_port_info_set_capability(info, caps)
+            self.lib.snd_seq_port_info_set_type(info, SND_SEQ_PORT_TYPE_MIDI_GENERIC | SND_SEQ_PORT_TYPE_APPLICATION)
+            if timestamp_queue is not None:
+                self.lib.snd_seq_port_info_set_timestamping(info, 1)
+                self.lib.snd_seq_port_info_set_timestamp_real(info, 1)
+                self.lib.snd_seq_port_info_set_timestamp_queue(info, timestamp_queue)
+            if (self.lib.snd_seq_create_port(self.seq, info) < 0):
+                raise SequencerError("can't create port %s" % name.decode())
+            return self.lib.snd_seq_port_info_get_port(info)
+        finally:
+            self.lib.snd_seq_port_info_free(info)
+
+    def output_port(self, name):
+        port = self.create_port(name, SND_SEQ_PORT_CAP_READ | SND_SEQ_PORT_CAP_SUBS_READ)
+        return AlsaOutputPort(self, port)
+
+    def input_port(self):
+        return AlsaInputPort(self)
+
+    def output_direct(self, event):
+        """Envoie l'événement sans queue ni buffer, output_lock doit être pris"""
+        return self.lib.snd_seq_event_output_direct(self.seq, byref(event))
+
+    def read_midi(self):
+        """Messages en attente, sous forme (message, horodatage en secondes ou None)"""
+        ev = self.input_event
+        messages = []
+        while True:
+            n = self.lib.snd_seq_event_input(self.seq, byref(ev))
+            if n == -errno.ENOSPC:
+                # Les événements ont été perdus dans le noyau
+                logging.error('MIDI overflow')
+                continue
+            if n < 0:
+                return messages
+            e = ev.contents
+            t = e.type
+            if t == SND_SEQ_EVENT_NOTEON or t == SND_SEQ_EVENT_NOTEOFF:
+                note = e.data.note
+                message = [(NOTE_ON if t == SND_SEQ_EVENT_NOTEON else NOTE_OFF) | note.channel,
+                           note.note, note.velocity]
+            elif t == SND_SEQ_EVENT_CONTROLLER:
+                control = e.data.control
+                message = [CONTROL_CHANGE | control.channel, control.param, control.value]
+            elif t == SND_SEQ_EVENT_PGMCHANGE:
+                control = e.data.control
+                message = [PROGRAM_CHANGE | control.channel, control.value]
+            else:
+                # SysEx, horloge, abonnements: ignorés comme avec rtmidi
+                continue
+            if e.flags & SND_SEQ_TIME_STAMP_REAL:
+                timestamp = e.time.time.tv_sec + e.time.time.tv_nsec * 1e-9
+            else:
+                timestamp = None
+            messages.append((message, timestamp))
+
+
+class AlsaOutputPort(object):
+    """Port de sortie avec l'interface send_message() des ports rtmidi"""
+    def __init__(self, sequencer, port):
+        self.sequencer = sequencer
+        self.port = port
+        self.address = sequencer.address(port)
+        # Un seul événement, réutilisé pour chaque message
+        ev = self.event = snd_seq_event_t()
+        ev.queue = SND_SEQ_QUEUE_DIRECT
+        ev.source.port = port
+        ev.dest.client = SND_SEQ_ADDRESS_SUBSCRIBERS
+        ev.dest.port = SND_SEQ_ADDRESS_UNKNOWN
+        self.sysex = None
+
+    def send_message(self, message):
+        with self.sequencer.output_lock:
+            if self.encode(message) and self.sequencer.output_direct(self.event) < 0:
+                logging.error("Echec d'envoi de %r", message)
+
+    def encode(self, message):
+        """Remplit l'événement à partir du message, renvoie False si non géré"""
+        ev = self.event
+        status = message[0]
+        kind = status & 0xF0
+        ev.flags = 0
+        if status == SYSTEM_EXCLUSIVE:
+            # Le buffer doit rester valide jusqu'à l'envoi
+            self.sysex = create_string_buffer(bytes(message), len(message))
+            ev.type = SND_SEQ_EVENT_SYSEX
+            ev.flags = SND_SEQ_EVENT_LENGTH_VARIABLE
+            ev.data.ext.len = len(message)
+            ev.data.ext.ptr = addressof(self.sysex)
+        elif kind == NOTE_ON or kind == NOTE_OFF:
+            ev.type = SND_SEQ_EVENT_NOTEON if kind == NOTE_ON else SND_SEQ_EVENT_NOTEOFF
+            note = ev.data.note
+            note.channel = status & 0x0F
+            note.note = message[1]
+            note.velocity = message[2]
+            note.off_velocity = 0
+            note.duration = 0
+        elif kind == CONTROL_CHANGE or kind == PROGRAM_CHANGE:
+            control = ev.data.control
+            control.channel = status & 0x0F
+            if kind == CONTROL_CHANGE:
+                ev.type = SND_SEQ_EVENT_CONTROLLER
+                control.param = message[1]
+                control.value = message[2]
+            else:
+                ev.type = SND_SEQ_EVENT_PGMCHANGE
+                control.param = 0
+                control.value = message[1]
+        else:
+            logging.error("Message non géré par le séquenceur: %r", message)
+            return False
+        return True
+
+
+class AlsaInputPort(threading.Thread):
+    """Appelle callback((message, deltatime), data) pour chaque message reçu,
+    comme MidiIn.set_callback() de rtmidi"""
+    def __init__(self, sequencer):
+        threading.Thread.__init__(self, name='AlsaInput', daemon=True)
+        self.sequencer = sequencer
+        self.address = sequencer.address(sequencer.in_port)
+        self.callback = None
+        self.data = None
+        self.last_time = None
+        self.stopped = False
+
+    def set_callback(self, callback, data=None):
+        self.callback = callback
+        self.data = data
+        if not self.is_alive():
+            self.start()
+
+    def cancel_callback(self):
+        self.callback = None
+
+    def close(self):
+        self.stopped = True
+        if self.is_alive():
+            self.join()
+
+    def run(self):
+        poller = select.poll()
+        for fd in self.sequencer.poll_descriptors():
+            poller.register(fd, select.POLLIN)
+        while not self.stopped:
+            if not poller.poll(500):
+                continue
+            for message, timestamp in self.sequencer.read_midi():
+                # Horodatage du séquenceur, ou à défaut heure de lecture
+                if timestamp is None:
+                    timestamp = time.monotonic()
+                deltatime = 0.0 if self.last_time is None else timestamp - self.last_time
+                self.last_time = timestamp
+                callback = self.callback
+                if callback is not None:
+                    callback((message, deltatime), self.data)
@@ -0,0 +1,235 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# Mesure de la latence et du débit du bridge avec Aeolus et le launchpad simulés
+
+import sys
+import getopt
+import json
+import logging
+import threading
+import time
+
+from aeolus_sim import AEOLUS_DUMP_NOTE, AeolusPort, AeolusSimulator
+from launchpad_sim import LaunchpadSimulator
+from bridge import AEOLUS_CC, CONTROL_CHANGE, LP_SYSEX_SESSION, NOTE_ON
+from launchpad005 import MidiInputHandler
+
+
+class TimedPort(object):
+    """Port de sortie qui horodate chaque message avant de le transmettre"""
+    def __init__(self, port):
+        self.port = port
+        self.last_time = None
+        self.last_message = None
+        self.count = 0
+
+    def send_message(self, message):
+        self.last_time = time.perf_counter()
+        self.last_message = message
+        self.count += 1
+        self.port.send_message(message)
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    n = len(samples)
+    if not n:
+        return {'count': 0}
+    return {
+        'count': n,
+        'p50_us': samples[n // 2] * 1e6,
+        'p99_us': samples[min(n - 1, n * 99 // 100)] * 1e6,
+        'max_us': samples[-1] * 1e6,
+    }
+
+
+class Bench(object):
+    """Bridge complet entre un Aeolus et un launchpad simulés"""
+    def __init__(self, queue_size=0):
+        self.aeolus = AeolusSimulator()
+        self.launchpad = LaunchpadSimulator()
+        self.to_aeolus = TimedPort(AeolusPort(self.aeolus))
+        self.to_launchpad = TimedPort(self.launchpad)
+        self.handler = MidiInputHandler(None, 0, self.to_launchpad, 0, self.to_aeolus, 0, queue_size)
+        self.launchpad.send_message(LP_SYSEX_SESSION)
+        self.handler.repaint()
+
+    def wait(self, port, count, timeout=1.0):
+        """En mode sans perte, attend que le worker ait envoyé count messages"""
+        deadline = time.perf_counter() + timeout
+        while port.count < count and time.perf_counter() < deadline:
+            time.sleep(0)
+
+    def drain(self, timeout=1.0):
+        """En mode sans perte, attend que le worker ait traité tout ce qui est
+        entré dans le buffer et envoyé ce qu'il a produit, en une ou plusieurs
+        rafales"""
+        if self.handler.worker is None:
+            return
+        deadline = time.perf_counter() + timeout
+        while (self.handler.worker.processed < self.handler.ingest.received
+               and time.perf_counter() < deadline):
+            time.sleep(0)
+
+    def wait_stop(self, count, timeout=1.0):
+        """Attend un numéro de registre vers Aeolus après count messages,
+        l'en-tête qui le précède pouvant être omis"""
+        deadline = time.perf_counter() + timeout
+        port = self.to_aeolus
+        while (port.count <= count or port.last_message[2] & 0x40) and time.perf_counter() < deadline:
+            time.sleep(0)
+
+    def deliver(self, messages):
+        for message in messages:
+            self.handler((message, 0.0))
+
+    def close(self):
+        self.handler.close()
+
+    def pad_to_aeolus(self, iterations):
+        """Appui sur un pad -> CC98 du registre vers to_aeolus"""
+        samples = []
+        for i in range(iterations):
+            x, y = 1 + i % 9, 1 + (i // 9) % 8
+            count = self.to_aeolus.count
+            start = time.perf_counter()
+            self.handler((self.launchpad.press(x, y), 0.0))
+            self.wait_stop(count)
+            samples.append(self.to_aeolus.last_time - start)
+            # L'écho d'Aeolus est traité hors mesure
+            self.deliver(self.aeolus.pump())
+        return samples
+
+    def echo_to_led(self, iterations):
+        """Écho CC98 d'Aeolus -> NOTE_ON vers le launchpad"""
+        samples = []
+        for i in range(iterations):
+            group, stop_number = i % 4, (i // 4) % 18
+            # Changement fait côté Aeolus (interface graphique)
+            self.aeolus.inbox.extend([[CONTROL_CHANGE, AEOLUS_CC, 0x40 | (3 << 4) | group],
+                                      [CONTROL_CHANGE, AEOLUS_CC, stop_number]])
+            echo = self.aeolus.pump()
+            count = self.to_launchpad.count + 1
+            start = time.perf_counter()
+            self.deliver(echo)
+            self.wait(self.to_launchpad, count)
+            samples.append(self.to_launchpad.last_time - start)
+        return samples
+
+    def dump_sync(self, iterations):
+        """Réponse complète à la note 23 -> dernière LED mise à jour"""
+        samples = []
+        for i in range(iterations):
+            # Couleurs différentes à chaque fois pour que toutes les LED changent
+            self.aeolus.types = [[(group + i) % 4] * 18 for group in range(4)]
+            self.aeolus.inbox.append([NOTE_ON, AEOLUS_DUMP_NOTE, 127])
+            dump = self.aeolus.pump()
+            start = time.perf_counter()
+            self.deliver(dump)
+            self.drain()
+            samples.append(self.to_launchpad.last_time - start)
+        return samples
+
+    def service_rate(self, count):
+        """Messages traités par seconde quand ils arrivent sans interruption"""
+        self.aeolus.inbox.append([NOTE_ON, AEOLUS_DUMP_NOTE, 127])
+        dump = self.aeolus.pump()
+        messages = (dump * (count // len(dump) + 1))[:count]
+        start = time.perf_counter()
+        self.deliver(messages)
+        self.drain(timeout=60.0)
+        return count / (time.perf_counter() - start)
+
+    def sustained(self, rate, duration):
+        """Appuis et échos simultanés à rate messages/s pendant duration secondes"""
+        metrics = self.handler.metrics
+        dropped = metrics.dropped
+        overflows = self.handler.ingest.overflows if self.handler.ingest is not None else 0
+        count = int(rate * duration / 2)
+        echo = [[CONTROL_CHANGE, AEOLUS_CC, 0x40 | (3 << 4)], [CONTROL_CHANGE, AEOLUS_CC, 0]]
+
+        def producer(messages):
+            period = 2.0 / rate
+            next_time = time.perf_counter()
+            for message in messages:
+                delay = next_time - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                next_time += period
+                self.handler((message, 0.0))
+        # Launchpad et Aeolus arrivent par deux threads
+        threads = [threading.Thread(target=producer, args=([self.launchpad.press(1, 1)] * count,)),
+                   threading.Thread(target=producer, args=((echo * count)[:count],))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.aeolus.inbox = []
+        result = {'rate': rate, 'offered': 2 * count, 'dropped': metrics.dropped - dropped}
+        if self.handler.ingest is not None:
+            result['overflows'] = self.handler.ingest.overflows - overflows
+            result['high_water'] = self.handler.ingest.high_water
+        return result
+
+
+def run(iterations=1000, queue_size=0, rates=(1000, 2000, 5000, 10000, 20000, 50000), duration=0.5):
+    bench = Bench(queue_size)
+    results = {
+        'queue_size': queue_size,
+        'pad_to_aeolus': percentiles(bench.pad_to_aeolus(iterations)),
+        'echo_to_led': percentiles(bench.echo_to_led(iterations)),
+        'dump_sync': percentiles(bench.dump_sync(max(1, iterations // 10))),
+        'service_rate_msgs_per_s': bench.service_rate(iterations * 10),
+    }
+    # Débit soutenu jusqu'au premier message perdu ou au premier débordement
+    sustained = []
+    for rate in rates:
+        result = bench.sustained(rate, duration)
+        sustained.append(result)
+        if result['dropped'] or result.get('overflows'):
+            break
+    results['sustained'] = sustained
+    results['metrics'] = bench.handler.metrics.snapshot()
+    results['aeolus'] = bench.aeolus.stats()
+    results['launchpad'] = bench.launchpad.stats()
+    bench.close()
+    return results
+
+
+def main(argv=None):
+
+    def usage():
+        print(sys.argv[0], "-h -n iterations -q taille -o fichier")
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hn:q:o:", ["help", "iterations=", "queue=", "output="])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+    iterations = 1000
+    queue_size = 0
+    output = None
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-n", "--iterations"):
+            iterations = int(a)
+        elif o in ("-q", "--queue"):
+            queue_size = int(a)
+        elif o in ("-o", "--output"):
+            output = a
+    # Les pertes sont comptées, pas besoin de les afficher
+    logging.disable(logging.ERROR)
+    results = run(iterations, queue_size)
+    if output is None:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,753 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# Traduction launchpad <-> Aeolus, sans entrée/sortie MIDI
+
+import logging
+
+# Octets de statut MIDI (comme rtmidi.midiconstants)
+NOTE_ON = 0x90
+CONTROL_CHANGE = 0xB0
+
+AEOLUS_CC = 98
+AEOLUS_CC2 = AEOLUS_CC + 1
+MAX_STOPS = 18
+MAX_GROUPS = 4
+LP_BLACK = 0
+LP_WHITE = 3
+LP_BLUE = 45
+LP_LTBLUE = 36
+LP_RED = 6
+LP_LTRED = 52
+LP_GREEN = 16
+LP_LTGREEN = 64
+LP_YELLOW = 12
+LP_BROWN = 105
+keyuptypecolor = [LP_BLUE, LP_BLACK, LP_BROWN, LP_LTGREEN]
+keydowntypecolor = [LP_LTBLUE, LP_WHITE, LP_YELLOW, LP_GREEN]
+# En-tête SysEx Launchpad MK2 et commande de couleur de plusieurs LED
+LP_SYSEX_HEADER = [0xF0, 0x00, 0x20, 0x29, 0x02, 0x18]
+LP_SYSEX_SET_LEDS = 0x0A
+# Passage en mode session
+LP_SYSEX_SESSION = LP_SYSEX_HEADER + [0x22, 0x00, 0xF7]
+# Nombre maximum de LED par message SysEx
+LP_SYSEX_MAX_LEDS = 80
+# Couleur inconnue (état du launchpad après passage en mode session)
+LP_UNKNOWN = 0xFF
+# Notes des pads en mode session: 8 lignes de 8 pads plus la colonne de droite
+LP_PADS = [10 * y + x for y in range(1, 9) for x in range(1, 10)]
+# Boutons ronds de la ligne supérieure: contrôleurs 68h à 6Fh, et mêmes
+# index dans le SysEx de couleur des LED
+LP_TOP_FIRST = 0x68
+LP_TOP_ROW = list(range(LP_TOP_FIRST, LP_TOP_FIRST + 8))
+LP_LEDS = LP_PADS + LP_TOP_ROW
+# Couleur des boutons du dessus selon qu'une registration y est mémorisée
+LP_PRESET_EMPTY = LP_BLACK
+LP_PRESET_STORED = LP_GREEN
+# Durée d'appui sur un bouton du dessus pour mémoriser, en secondes
+PRESET_HOLD = 1.0
+# Délai maximum de l'écho d'Aeolus confirmant un changement, en secondes
+ACK_TIMEOUT = 1.0
+# Silence d'Aeolus marquant la fin de sa réponse à la note 23, et délai
+# maximum de cette réponse, en secondes
+DUMP_QUIET = 0.2
+DUMP_TIMEOUT = 2.0
+# Nouvelles demandes au plus après une réponse incomplète
+SYNC_RETRIES = 2
+# Note spéciale demandant à Aeolus l'état de tous ses registres
+AEOLUS_DUMP_NOTE = 23
+# Pas de registre associé à ce pad / pas de pad pour ce registre
+NO_STOP = 0xFF
+# Destinations des messages sortants
+LAUNCHPAD = 'launchpad'
+AEOLUS = 'aeolus'
+
+# Traces des messages MIDI, désactivées par défaut
+trace = logging.getLogger('lp2aeolus.trace')
+
+
+def aeolus_cc_to_note(group, stop_number):
+    """Disposition par défaut: 2 lignes de 9 pads par groupe à partir du haut"""
+    y = 1 + 2 * (3 - group) + 1 - (stop_number // 9)
+    x = 1 + (stop_number % 9)
+    return(10 * y + x)
+
+
+class GridLayout(object):
+    """Tables précalculées note <-> (groupe, registre)"""
+    def __init__(self, pads):
+        # Indexées par la note du pad
+        self.note_group = bytearray([NO_STOP] * 128)
+        self.note_stop = bytearray([NO_STOP] * 128)
+        # Indexée par (groupe << 5) | registre, tels que codés dans les
+        # messages d'Aeolus: les valeurs hors limites donnent NO_STOP
+        self.stop_note = bytearray([NO_STOP] * 256)
+        for note, group, stop_number in pads:
+            self.note_group[note] = group
+            self.note_stop[note] = stop_number
+            self.stop_note[(group << 5) | stop_number] = note
+
+    @classmethod
+    def default(cls):
+        return cls((aeolus_cc_to_note(group, stop_number), group, stop_number)
+                   for group in range(MAX_GROUPS) for stop_number in range(MAX_STOPS))
+
+    @classmethod
+    def load(cls, filename):
+        """Lit une disposition: une ligne 'note groupe registre' par pad"""
+        pads = []
+        with open(filename) as f:
+            for line in f:
+                line = line.split('#')[0].split()
+                if line:
+                    note, group, stop_number = (int(v) for v in line)
+                    if not (0 <= note < 128 and 0 <= group < 8 and 0 <= stop_number < 32):
+                        raise ValueError("Pad invalide: %s" % ' '.join(line))
+                    pads.append((note, group, stop_number))
+        return cls(pads)
+
+
+class StopState(object):
+    """État des registres: un masque de bits par groupe, couleurs des pads en bytearray"""
+    __slots__ = ('engaged', 'upcolor', 'downcolor')
+
+    def __init__(self, engaged=None, upcolor=None, downcolor=None):
+        # Bit n du masque d'un groupe: registre n enclenché
+        self.engaged = list(engaged) if engaged is not None else [0] * 8
+        # Couleurs des pads relâchés / enfoncés, indexées par note
+        self.upcolor = bytearray(upcolor) if upcolor is not None else bytearray([LP_BLACK] * 128)
+        self.downcolor = bytearray(downcolor) if downcolor is not None else bytearray([LP_WHITE] * 128)
+
+    def copy(self):
+        return StopState(self.engaged, self.upcolor, self.downcolor)
+
+    def __eq__(self, other):
+        return (self.engaged == other.engaged and self.upcolor == other.upcolor
+                and self.downcolor == other.downcolor)
+
+    def is_engaged(self, group, stop_number):
+        return (self.engaged[group] >> stop_number) & 1 == 1
+
+    def set(self, group, stop_number, value):
+        """Renvoie True si l'état du registre a changé"""
+        mask = self.engaged[group]
+        bit = 1 << stop_number
+        new_mask = mask | bit if value else mask & ~bit
+        self.engaged[group] = new_mask
+        return new_mask != mask
+
+    def toggle(self, group, stop_number):
+        """Inverse le registre et renvoie son nouvel état"""
+        self.engaged[group] ^= 1 << stop_number
+        return (self.engaged[group] >> stop_number) & 1 == 1
+
+    def clear_group(self, group):
+        """Désactive tout le groupe et renvoie le masque des registres désactivés"""
+        mask = self.engaged[group]
+        self.engaged[group] = 0
+        return mask
+
+    def count(self, group):
+        return bin(self.engaged[group]).count('1')
+
+    def diff(self, other):
+        """Masques des registres dont l'état diffère, par groupe"""
+        return [a ^ b for a, b in zip(self.engaged, other.engaged)]
+
+    def color(self, note, engaged):
+        return self.downcolor[note] if engaged else self.upcolor[note]
+
+
+def mask_bits(mask):
+    """Numéros des bits à 1 d'un masque"""
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class LedRenderer(object):
+    """Envoie au launchpad les seuls pads dont la couleur a changé"""
+    def __init__(self, midi_channel_out=0, batched=True):
+        self.midi_channel_out = midi_channel_out
+        self.batched = batched
+        # Couleurs voulues et couleurs réellement affichées par le launchpad
+        self.desired = bytearray([LP_BLACK] * 128)
+        self.shown = bytearray([LP_UNKNOWN] * 128)
+        # Pads modifiés depuis le dernier envoi
+        self.dirty = set()
+        # Pads modifiés mais retenus jusqu'à release()
+        self.held = set()
+
+    def set(self, note, color):
+        self.desired[note] = color
+        self.dirty.add(note)
+
+    def hold(self, note, color):
+        """Comme set(), mais envoyé seulement après release()"""
+        self.desired[note] = color
+        self.held.add(note)
+
+    def release(self):
+        self.dirty |= self.held
+        self.held.clear()
+
+    def repaint(self):
+        """Oublie l'état affiché pour tout renvoyer au prochain flush"""
+        for note in LP_LEDS:
+            self.shown[note] = LP_UNKNOWN
+        self.dirty.update(LP_LEDS)
+
+    def flush(self):
+        """Messages à envoyer au launchpad pour afficher l'état voulu"""
+        if not self.dirty:
+            return []
+        leds = []
+        for note in sorted(self.dirty):
+            color = self.desired[note]
+            if color != self.shown[note]:
+                self.shown[note] = color
+                leds.append((note, color))
+        self.dirty.clear()
+        messages = []
+        if self.batched and len(leds) > 1:
+            # Un seul SysEx pour toutes les LED (découpé si nécessaire)
+            for i in range(0, len(leds), LP_SYSEX_MAX_LEDS):
+                sysex = LP_SYSEX_HEADER + [LP_SYSEX_SET_LEDS]
+                for note, color in leds[i:i + LP_SYSEX_MAX_LEDS]:
+                    sysex += [note, color]
+                sysex.append(0xF7)
+                messages.append(sysex)
+        else:
+            for note, color in leds:
+                # Les boutons du dessus sont des contrôleurs, pas des notes
+                status = CONTROL_CHANGE if note >= LP_TOP_FIRST else NOTE_ON
+                messages.append([status + self.midi_channel_out, note, color])
+        return messages
+
+
+class AeolusEncoder(object):
+    """Messages CC98 vers Aeolus: l'en-tête mode/groupe reste valable pour
+    les registres suivants, il n'est renvoyé que s'il change"""
+    def __init__(self, midi_channel_out=0):
+        self.status = CONTROL_CHANGE + midi_channel_out
+        # Dernier en-tête envoyé sur le port, None si inconnu d'Aeolus
+        self.last_header = None
+        self.saved = 0
+
+    def reset(self):
+        """À appeler à chaque (re)connexion: Aeolus a pu oublier l'en-tête"""
+        self.last_header = None
+
+    def encode(self, mode, group, stop_numbers, messages):
+        header = 0x40 + (mode << 4) + group
+        if header != self.last_header:
+            messages.append([self.status, AEOLUS_CC, header])
+            self.last_header = header
+        else:
+            self.saved += 1
+        for stop_number in stop_numbers:
+            messages.append([self.status, AEOLUS_CC, stop_number])
+
+
+class AeolusSync(object):
+    """Suivi de la réponse d'Aeolus à la note 23: registres signalés, fin
+    détectée par le silence d'Aeolus, trous et erreurs de protocole"""
+    def __init__(self):
+        self.active = False
+        self.started = None
+        # Dernier message d'Aeolus, pendant une réponse ou non
+        self.last_message = None
+        # Pendant la réponse: masques par groupe des registres dont le type
+        # (CC99) est arrivé, masque des groupes remis à zéro (CC98 mode 0)
+        self.typed = [0] * 8
+        self.reset_groups = 0
+        # Registres signalés par la dernière réponse complète
+        self.known = [0] * 8
+        # Erreurs de protocole ("Mode non défini", "Type non défini")
+        self.errors = 0
+        self.complete = False
+        self.retries = 0
+        self.requests = 0
+        self.incomplete = 0
+        # Durée de la dernière réponse complète, en secondes
+        self.duration = None
+
+    def begin(self, now):
+        self.active = True
+        self.started = now
+        self.last_message = None
+        self.typed = [0] * 8
+        self.reset_groups = 0
+        self.errors = 0
+        self.requests += 1
+
+    def finished(self, now):
+        """Vrai quand Aeolus s'est tu après avoir répondu, ou au délai maximum"""
+        if self.last_message is not None and now - self.last_message >= DUMP_QUIET:
+            return True
+        return now - self.started >= DUMP_TIMEOUT
+
+    def end(self):
+        """Termine la réponse en cours, renvoie la liste des problèmes constatés"""
+        self.active = False
+        problems = []
+        if self.last_message is None:
+            problems.append("pas de réponse")
+        typed_groups = 0
+        for group, mask in enumerate(self.typed):
+            if mask:
+                typed_groups |= 1 << group
+        # Chaque groupe envoie les types de ses registres puis sa remise à zéro
+        partial = typed_groups ^ self.reset_groups
+        if partial:
+            problems.append("groupes incomplets %s" % list(mask_bits(partial)))
+        # Registres signalés la dernière fois et absents cette fois-ci
+        lost = sum(bin(known & ~typed).count('1') for known, typed in zip(self.known, self.typed))
+        if lost:
+            problems.append("%d registres manquants" % lost)
+        if self.errors:
+            problems.append("%d erreurs de protocole" % self.errors)
+        self.complete = not problems
+        if problems:
+            self.incomplete += 1
+        else:
+            # Les messages sont horodatés par rtmidi, la demande par l'horloge du
+            # handler: un léger décalage ne doit pas donner une durée négative
+            self.duration = max(0.0, self.last_message - self.started)
+            self.known = list(self.typed)
+            self.retries = 0
+        return problems
+
+    def accept(self):
+        """Réponse incomplète après toutes les demandes: Aeolus a peut-être
+        changé d'instrument, ce qu'il a signalé fait foi. Seule une nouvelle
+        erreur de protocole donnera droit à de nouvelles demandes"""
+        self.known = list(self.typed)
+        self.errors = 0
+        self.retries = 0
+
+
+class BridgeMetrics(object):
+    """Compteurs du bridge: écrits par le seul thread MIDI, lus sans verrou"""
+    # Types de messages entrants comptés
+    kinds = ('pad', 'cc98_mode', 'cc98_stop', 'cc99_type', 'cc99_stop', 'top_row', 'unexpected')
+    # Histogramme du temps de traitement: case n pour une durée < 2**n µs
+    buckets = 16
+
+    def __init__(self):
+        self.counts = [0] * len(self.kinds)
+        self.dropped = 0
+        self.service_time = [0] * self.buckets
+        self.sent = {LAUNCHPAD: 0, AEOLUS: 0}
+        # Délai appui -> écho d'Aeolus, mêmes cases que le temps de traitement
+        self.ack_time = [0] * self.buckets
+        self.ack_timeouts = 0
+        self.ack_mismatches = 0
+
+    def add_service_time(self, seconds):
+        self.service_time[min(int(seconds * 1e6).bit_length(), self.buckets - 1)] += 1
+
+    def add_ack_time(self, seconds):
+        self.ack_time[min(int(seconds * 1e6).bit_length(), self.buckets - 1)] += 1
+
+    def snapshot(self):
+        """Copie cohérente à peu près: chaque liste est copiée d'un bloc"""
+        counts = list(self.counts)
+        service_time = list(self.service_time)
+        ack_time = list(self.ack_time)
+        labels = ['<%d' % (1 << n) for n in range(self.buckets - 1)] + ['>=%d' % (1 << (self.buckets - 2))]
+        return {
+            'messages': dict(zip(self.kinds, counts)),
+            'dropped': self.dropped,
+            'service_time_us': dict(zip(labels, service_time)),
+            'sent': dict(self.sent),
+            'ack_time_us': dict(zip(labels, ack_time)),
+            'ack_timeouts': self.ack_timeouts,
+            'ack_mismatches': self.ack_mismatches,
+        }
+
+
+# Index dans BridgeMetrics.counts
+(MSG_PAD, MSG_CC98_MODE, MSG_CC98_STOP, MSG_CC99_TYPE, MSG_CC99_STOP, MSG_TOP_ROW,
+ MSG_UNEXPECTED) = range(len(BridgeMetrics.kinds))
+
+
+class BridgeEngine(object):
+    """Machine d'état launchpad <-> Aeolus, sans entrée/sortie"""
+    def __init__(self, midi_channel_in=0, midi_channel_out=0, midi_channel_out2=0, batched_leds=True, layout=None, tracing=False):
+        self.midi_channel_in = int(midi_channel_in)
+        self.midi_channel_out = int(midi_channel_out)
+        self.midi_channel_out2 = int(midi_channel_out2)
+        self.leds = LedRenderer(self.midi_channel_out, batched_leds)
+        self.encoder = AeolusEncoder(self.midi_channel_out2)
+        self.layout = layout if layout is not None else GridLayout.default()
+        # Un simple booléen: une trace désactivée ne coûte qu'un test
+        self.tracing = tracing
+        self.state = StopState()
+        self.mode_in = None
+        self.type_in = None
+        self.group_in = None
+        self.now = 0.0
+        # Registrations mémorisées sur les boutons du dessus (masques par groupe)
+        self.presets = [None] * len(LP_TOP_ROW)
+        self.preset_pressed_at = [None] * len(LP_TOP_ROW)
+        # Changements envoyés à Aeolus et pas encore confirmés par son écho,
+        # indexés par (groupe << 5) | registre:
+        # [échéance, instant de l'appui, état attendu, échos attendus, état confirmé]
+        self.pending_acks = {}
+        # Pendant la réponse d'Aeolus à la note 23, les LED qu'elle change ne
+        # sont envoyées qu'à la fin: seules les différences avec l'état affiché
+        # partent. Les appuis sur les pads restent affichés immédiatement
+        self.hold_leds = False
+        self.sync = AeolusSync()
+        self.metrics = BridgeMetrics()
+        self.counts = self.metrics.counts
+        # Messages sortants en attente, par destination
+        self.outgoing = {LAUNCHPAD: [], AEOLUS: []}
+        self.build_dispatch()
+
+    def process(self, timestamp, message, source=None):
+        """Traite un message entrant, les sorties sont accumulées jusqu'au flush"""
+        self.now = timestamp
+        if self.tracing:
+            trace.debug("@%0.6f %r", timestamp, message)
+        if self.pending_acks or self.hold_leds:
+            self.tick(timestamp)
+        self.status_dispatch[message[0]](message)
+
+    def tick(self, now):
+        """Échéances: fin de la réponse d'Aeolus, changements non confirmés"""
+        sync = self.sync
+        if sync.active:
+            self.check_dump(now)
+        elif sync.errors and sync.retries < SYNC_RETRIES and now - sync.last_message >= DUMP_QUIET:
+            # Messages perdus hors réponse: tout redemander une fois Aeolus silencieux
+            sync.retries += 1
+            logging.warning("Erreur de protocole avec Aeolus, nouvelle demande d'état")
+            self.send_dump_request(now)
+        self.expire_acks(now)
+
+    def request_dump(self, now):
+        """Demande à Aeolus l'état de tous ses registres (note 23)"""
+        # Demande extérieure (démarrage, reconnexion): nouvelles demandes permises
+        self.sync.retries = 0
+        self.send_dump_request(now)
+
+    def send_dump_request(self, now, hold=True):
+        message = [NOTE_ON + self.midi_channel_out2, AEOLUS_DUMP_NOTE, 127]
+        logging.info("Envoi de %r", message)
+        self.outgoing[AEOLUS].append(message)
+        self.sync.begin(now)
+        self.hold_leds = hold
+
+    def check_dump(self, now):
+        sync = self.sync
+        if not sync.finished(now):
+            return
+        self.hold_leds = False
+        self.leds.release()
+        problems = sync.end()
+        if not problems:
+            logging.info("Synchronisé avec Aeolus en %0.3f s", sync.duration)
+            missing = self.missing_stops()
+            if missing:
+                logging.info("Pads sans registre dans Aeolus: %s", missing)
+        elif sync.retries < SYNC_RETRIES:
+            sync.retries += 1
+            logging.warning("Réponse d'Aeolus incomplète (%s), nouvelle demande", ', '.join(problems))
+            # Les LED suivent sans attendre: la réponse précédente a pu être vide
+            self.send_dump_request(now, False)
+        else:
+            sync.accept()
+            logging.error("Réponse d'Aeolus incomplète (%s) après %d demandes", ', '.join(problems),
+                          SYNC_RETRIES + 1)
+
+    def missing_stops(self):
+        """(groupe, registre) des pads dont Aeolus n'a pas donné le type"""
+        layout = self.layout
+        typed = self.sync.known
+        return [(layout.note_group[note], layout.note_stop[note]) for note in LP_PADS
+                if layout.note_group[note] != NO_STOP
+                and not typed[layout.note_group[note]] >> layout.note_stop[note] & 1]
+
+    def restore(self, state, presets):
+        """Reprend un état sauvegardé, toutes les LED sont à redessiner"""
+        self.state = state
+        self.presets = list(presets)
+        for note in LP_PADS:
+            if self.layout.note_group[note] != NO_STOP:
+                engaged = self.state.is_engaged(self.layout.note_group[note], self.layout.note_stop[note])
+                self.leds.set(note, self.state.color(note, engaged))
+        for n, preset in enumerate(self.presets):
+            self.leds.set(LP_TOP_ROW[n], LP_PRESET_EMPTY if preset is None else LP_PRESET_STORED)
+
+    def expire_acks(self, now):
+        """Annule les changements qu'Aeolus n'a pas confirmés avant l'échéance"""
+        expired = [key for key, entry in self.pending_acks.items() if entry[0] <= now]
+        for key in expired:
+            confirmed = self.pending_acks.pop(key)[4]
+            group, stop_number = key >> 5, key & 0x1F
+            self.metrics.ack_timeouts += 1
+            logging.warning("Pas de confirmation d'Aeolus: groupe %d registre %d", group, stop_number)
+            if self.state.set(group, stop_number, confirmed):
+                note = self.layout.stop_note[key]
+                if note != NO_STOP:
+                    self.leds.set(note, self.state.color(note, confirmed))
+
+    def expect_ack(self, group, stop_number, engaged):
+        """Note le changement envoyé à Aeolus, dont on attend l'écho"""
+        key = (group << 5) | stop_number
+        entry = self.pending_acks.get(key)
+        if entry is None:
+            self.pending_acks[key] = [self.now + ACK_TIMEOUT, self.now, engaged, 1, not engaged]
+        else:
+            # Nouvel appui avant l'écho du précédent
+            entry[0] = self.now + ACK_TIMEOUT
+            entry[1] = self.now
+            entry[2] = engaged
+            entry[3] += 1
+
+    def consume_ack(self, group, stop_number, engaged):
+        """Vrai si l'écho confirme un changement déjà appliqué localement"""
+        key = (group << 5) | stop_number
+        entry = self.pending_acks.get(key)
+        if entry is None:
+            return False
+        entry[3] -= 1
+        if entry[3]:
+            # Écho d'un appui intermédiaire, l'état final reste à confirmer:
+            # c'est vers cet état, connu d'Aeolus, qu'on reviendrait
+            entry[4] = engaged
+            return True
+        del self.pending_acks[key]
+        if engaged == entry[2]:
+            self.metrics.add_ack_time(self.now - entry[1])
+            return True
+        # Aeolus a fait autre chose que prévu: son état fait foi
+        self.metrics.ack_mismatches += 1
+        return False
+
+    def flush(self):
+        """Renvoie et oublie les messages sortants, par destination"""
+        self.outgoing[LAUNCHPAD].extend(self.leds.flush())
+        outgoing = self.outgoing
+        self.outgoing = {LAUNCHPAD: [], AEOLUS: []}
+        return outgoing
+
+    def process_many(self, events):
+        """Traite une suite de (horodatage, message, source) en une seule rafale"""
+        for timestamp, message, source in events:
+            self.process(timestamp, message, source)
+        return self.flush()
+
+    def repaint(self):
+        """Tout renvoyer au launchpad au prochain flush"""
+        self.leds.repaint()
+
+    def build_dispatch(self):
+        """Construit les tables d'aiguillage par octet de statut et par contrôleur"""
+        self.status_dispatch = [self.on_unexpected] * 256
+        self.status_dispatch[CONTROL_CHANGE + self.midi_channel_in] = self.on_control_change
+        self.status_dispatch[NOTE_ON + self.midi_channel_in] = self.on_note_on
+        # Indexée par (contrôleur << 1) | bit 40h de la valeur
+        self.cc_dispatch = [self.on_unexpected_cc] * 256
+        # Les numéros de contrôleur utilisés par les boutons ronds
+        # de la ligne supérieure ne changent pas quel que soit le
+        # mode, c'est toujours de 68h à 6Fh
+        for controller in LP_TOP_ROW:
+            self.register_cc(controller, self.on_top_button)
+        # Les CC d'Aeolus portent soit un en-tête (bit 40h), soit un registre
+        self.register_cc(AEOLUS_CC, self.on_aeolus_stop, self.on_aeolus_mode)
+        self.register_cc(AEOLUS_CC2, self.on_aeolus_type_stop, self.on_aeolus_type)
+
+    def register_cc(self, controller, handler, header_handler=None):
+        """Associe un contrôleur à une méthode, éventuellement selon le bit 40h"""
+        self.cc_dispatch[controller << 1] = handler
+        self.cc_dispatch[(controller << 1) | 1] = handler if header_handler is None else header_handler
+
+    def on_control_change(self, message):
+        self.cc_dispatch[(message[1] << 1) | ((message[2] >> 6) & 1)](message)
+
+    def on_top_button(self, message):
+        self.counts[MSG_TOP_ROW] += 1
+        n = message[1] - LP_TOP_FIRST
+        if self.tracing:
+            trace.debug('Launchpad: Bouton du dessus %d valeur %d', n, message[2])
+        # Appui long: mémorise la registration, appui court: la rappelle
+        if message[2]:
+            self.preset_pressed_at[n] = self.now
+            return
+        pressed_at = self.preset_pressed_at[n]
+        if pressed_at is None:
+            return
+        self.preset_pressed_at[n] = None
+        if self.now - pressed_at >= PRESET_HOLD:
+            self.store_preset(n)
+        else:
+            self.recall_preset(n)
+
+    def store_preset(self, n):
+        self.presets[n] = list(self.state.engaged)
+        self.leds.set(LP_TOP_ROW[n], LP_PRESET_STORED)
+        if self.tracing:
+            trace.debug('Registration %d mémorisée', n)
+
+    def recall_preset(self, n):
+        """Envoie à Aeolus les seuls changements, un en-tête par groupe et par mode"""
+        preset = self.presets[n]
+        if preset is None:
+            return
+        if self.tracing:
+            trace.debug('Rappel de la registration %d', n)
+        stop_note = self.layout.stop_note
+        for group, target in enumerate(preset):
+            current = self.state.engaged[group]
+            if current == target:
+                continue
+            self.state.engaged[group] = target
+            for mode, mask in ((1, current & ~target), (2, target & ~current)):
+                if not mask:
+                    continue
+                stop_numbers = list(mask_bits(mask))
+                self.send_aeolus(mode, group, stop_numbers)
+                for stop_number in stop_numbers:
+                    self.expect_ack(group, stop_number, mode == 2)
+                    note = stop_note[(group << 5) | stop_number]
+                    if note != NO_STOP:
+                        self.leds.set(note, self.state.color(note, mode == 2))
+
+    def set_aeolus_led(self, note, color):
+        """LED changée par un message d'Aeolus, retenue pendant sa réponse à la note 23"""
+        if self.hold_leds:
+            self.leds.hold(note, color)
+        else:
+            self.leds.set(note, color)
+
+    def send_aeolus(self, mode, group, stop_numbers):
+        """Un en-tête mode/groupe, si besoin, suivi des registres auxquels il s'applique"""
+        self.encoder.encode(mode, group, stop_numbers, self.outgoing[AEOLUS])
+
+    def aeolus_connected(self):
+        """Aeolus vient d'être (re)connecté: le prochain en-tête sera envoyé"""
+        self.encoder.reset()
+
+    def on_aeolus_mode(self, message):
+        self.counts[MSG_CC98_MODE] += 1
+        self.sync.last_message = self.now
+        # Message mode/groupe d'Aeolus
+        self.mode_in = (message[2] >> 4) & 0x03
+        self.group_in = message[2] & 0x07
+        if self.tracing:
+            trace.debug("Aeolus: Mode %d group %d", self.mode_in, self.group_in)
+        if self.mode_in == 0:
+            # Remise à zéro du groupe
+            self.mode_in = None
+            self.sync.reset_groups |= 1 << self.group_in
+            if self.pending_acks:
+                # L'état envoyé par Aeolus remplace les changements en attente
+                for key in [key for key in self.pending_acks if key >> 5 == self.group_in]:
+                    del self.pending_acks[key]
+            if self.tracing:
+                trace.debug("Désactivation du groupe %d", self.group_in)
+            stop_note = self.layout.stop_note
+            group_base = self.group_in << 5
+            for stop_number in mask_bits(self.state.clear_group(self.group_in)):
+                note = stop_note[group_base | stop_number]
+                if note != NO_STOP:
+                    self.set_aeolus_led(note, self.state.upcolor[note])
+
+    def on_aeolus_stop(self, message):
+        self.counts[MSG_CC98_STOP] += 1
+        self.sync.last_message = self.now
+        # Message de numéro de registre d'Aeolus
+        if self.mode_in is None:
+            self.sync.errors += 1
+            logging.error("Mode non défini")
+            return
+        stop_number_in = message[2] & 0x1F
+        if self.tracing:
+            trace.debug("Aeolus: mode %d groupe %d registre %d", self.mode_in, self.group_in, stop_number_in)
+        if self.mode_in == 1:
+            # Désactivation d'un registre
+            v = False
+        elif self.mode_in == 2:
+            # Activation d'un registre
+            v = True
+        else:  # self.mode_in == 3
+            # Inversion de l'état d'un registre
+            v = not self.state.is_engaged(self.group_in, stop_number_in)
+        if self.pending_acks and self.consume_ack(self.group_in, stop_number_in, v):
+            # Écho attendu: état et LED sont déjà à jour
+            return
+        if self.state.set(self.group_in, stop_number_in, v):
+            # Calcul de la note à partir du groupe et du registre
+            # Ne pas tenir compte des touches absentes launchpad:
+            # la table donne NO_STOP pour les registres sans pad
+            note = self.layout.stop_note[(self.group_in << 5) | stop_number_in]
+            if note != NO_STOP:
+                self.set_aeolus_led(note, self.state.color(note, v))
+
+    def on_aeolus_type(self, message):
+        self.counts[MSG_CC99_TYPE] += 1
+        self.sync.last_message = self.now
+        # Ce nouveau CC provient d'Aeolus et définit le type
+        # d'élément du GUI, et donc sa couleur
+        # Message type/groupe d'Aeolus
+        self.type_in = (message[2] >> 4) & 0x03
+        self.group_in = message[2] & 0x07
+        if self.tracing:
+            trace.debug("Aeolus: type %d groupe %d", self.type_in, self.group_in)
+
+    def on_aeolus_type_stop(self, message):
+        self.counts[MSG_CC99_STOP] += 1
+        self.sync.last_message = self.now
+        # Numéro de registre d'Aeolus
+        if self.type_in is None:
+            self.sync.errors += 1
+            logging.error("Type non défini")
+            return
+        self.stop_number_in = message[2] & 0x1F
+        self.sync.typed[self.group_in] |= 1 << self.stop_number_in
+        note = self.layout.stop_note[(self.group_in << 5) | self.stop_number_in]
+        if note == NO_STOP:
+            return
+        self.state.upcolor[note] = keyuptypecolor[self.type_in]
+        self.state.downcolor[note] = keydowntypecolor[self.type_in]
+        if self.tracing:
+            trace.debug("Aeolus: type %d groupe %d registre %d note %d couleurs %d %d", self.type_in, self.group_in,
+                        self.stop_number_in, note, self.state.downcolor[note], self.state.upcolor[note])
+        self.set_aeolus_led(note, self.state.color(note, self.state.is_engaged(self.group_in, self.stop_number_in)))
+
+    def on_note_on(self, message):
+        self.counts[MSG_PAD] += 1
+        # Le launchpad est exploité en mode session
+        # Ce mode convient bien pour utiliser le launchpad comme une
+        # grille: ajouter un correspond à un déplacement d'une
+        # colonne vers la droite, ajouter 10 correspond à une ligne
+        # vers le haut
+        note = message[1]
+        if self.tracing:
+            trace.debug('Launchpad: Bouton colonne %d ligne %d valeur %d', note % 10, note // 10, message[2])
+        group = self.layout.note_group[note]
+        if group == NO_STOP or message[2] != 0x7F:
+            # Pad sans registre associé ou relachement du pad, aucun changement
+            return
+        # Appui sur le pad, changement d'état
+        stop_number = self.layout.note_stop[note]
+        engaged = self.state.toggle(group, stop_number)
+        color = self.state.color(note, engaged)
+        self.leds.set(note, color)
+        # Envoi vers Aeolus sur le deuxième port de sortie
+        mode = 2 if engaged else 1  # action 2 pour on, 1 pour off
+        if self.tracing:
+            trace.debug('Envoi vers Aeolus: mode %d groupe %d registre %d couleur %d', mode, group, stop_number, color)
+        self.send_aeolus(mode, group, (stop_number,))
+        self.expect_ack(group, stop_number, engaged)
+
+    def on_unexpected_cc(self, message):
+        self.counts[MSG_UNEXPECTED] += 1
+        logging.warning("Contrôleur MIDI inattendu: %s %s %s", message[0], message[1], message[2])
+
+    def on_unexpected(self, message):
+        self.counts[MSG_UNEXPECTED] += 1
+        logging.warning("Message MIDI inattendu: %r", message)
@@ -3,8 +3,19 @@
 # MPER 20171012
 
 import sys
+import asyncio
+import atexit
+import functools
 import getopt
+import heapq
 import logging
+import logging.handlers
+import queue
+import re
+import os
+import signal
+import socketserver
+import threading
 import time
 
 from subprocess import Popen
@@ -16,181 +27,362 @@ from rtmidi.midiconstants import (NOTE_OFF, NOTE_ON, CONTROL_CHANGE, PROGRAM_CHA
 from rtmidi import (API_LINUX_ALSA, MidiIn, MidiOut, get_compiled_api)
 
 import aconnect
+from alsamidi import AlsaSequencer
+from bridge import AEOLUS, LAUNCHPAD, LP_SYSEX_SESSION, MAX_GROUPS, BridgeEngine, GridLayout, trace
+from snapshot import SnapshotFile, encode as encode_snapshot
+from miditrace import TRACE_IN, TRACE_OUT, TRACE_PORT_AEOLUS, TRACE_PORT_IN, TRACE_PORT_LAUNCHPAD, TraceRecorder
 
-AEOLUS_CC = 98
-AEOLUS_CC2 = AEOLUS_CC + 1
-MAX_STOPS = 18
-MAX_GROUPS = 4
-LP_BLACK = 0
-LP_WHITE = 3
-LP_BLUE = 45
-LP_LTBLUE = 36
-LP_RED = 6
-LP_LTRED = 52
-LP_GREEN = 16
-LP_LTGREEN = 64
-LP_YELLOW = 12
-LP_BROWN = 105
-keyuptypecolor = [LP_BLUE, LP_BLACK, LP_BROWN, LP_LTGREEN]
-keydowntypecolor = [LP_LTBLUE, LP_WHITE, LP_YELLOW, LP_GREEN]
+# Les noms de port rtmidi se terminent par l'adresse ALSA client:port
+ADDRESS_RE = re.compile(r'(\d+):(\d+)$')
+# Noms de clients ALSA propres: "RtMidiIn Client", nom par défaut de rtmidi,
+# désignerait aussi l'énumération des ports, et Aeolus serait abonné au mauvais client
+MIDI_IN_CLIENT = 'lp2aeolus_in'
+REGISTRY_CLIENT = 'lp2aeolus ports'
+# Délai maximum par défaut de démarrage d'Aeolus, en secondes
+AEOLUS_STARTUP_TIMEOUT = 10.0
+# Taille par défaut du buffer d'entrée en mode sans perte
+INGEST_QUEUE_SIZE = 1024
+# Période de vérification des échéances de confirmation d'Aeolus, en secondes
+TICK_PERIOD = 0.1
+# Priorités des files de sortie: commandes (Aeolus, mode session) avant les LED
+PRIORITY_COMMAND = 0
+PRIORITY_LED = 1
+# Délai entre une annonce ALSA et la vérification des ports: un client
+# annonce son arrivée ou son départ, puis ses ports un par un
+HOTPLUG_SETTLE = 0.2
+# Ports MIDI via rtmidi ou directement sur le séquenceur ALSA
+BACKEND_RTMIDI = 'rtmidi'
+BACKEND_ALSA = 'alsa'
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Dépose l'enregistrement tel quel, le formatage est fait par le listener"""
+    def prepare(self, record):
+        return record
+
+
+def setup_logging(level=logging.WARNING):
+    """Envoie les logs vers un thread dédié pour ne jamais bloquer le thread MIDI"""
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler(sys.stdout))
+    root = logging.getLogger()
+    for h in root.handlers[:]:
+        root.removeHandler(h)
+    root.addHandler(DeferredQueueHandler(log_queue))
+    root.setLevel(level)
+    trace.setLevel(logging.DEBUG)
+    listener.start()
+    return listener
+
+
+class MidiRingBuffer(object):
+    """Buffer circulaire borné entre le callback rtmidi et le worker"""
+    def __init__(self, size=INGEST_QUEUE_SIZE):
+        self.size = size
+        self.slots = [None] * size
+        self.head = 0
+        self.count = 0
+        # Compteurs pour dimensionner le buffer
+        self.high_water = 0
+        self.overflows = 0
+        self.received = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def put(self, item):
+        with self.cond:
+            if self.count == self.size:
+                # Buffer plein: on attend le worker plutôt que de perdre
+                # l'événement, rtmidi garde les suivants dans sa propre file
+                self.overflows += 1
+                while self.count == self.size and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+            self.slots[(self.head + self.count) % self.size] = item
+            self.count += 1
+            self.received += 1
+            if self.count > self.high_water:
+                self.high_water = self.count
+            self.cond.notify_all()
+
+    def get_all(self, timeout=None):
+        """Retire tous les événements en attente, bloque si le buffer est vide"""
+        with self.cond:
+            while self.count == 0:
+                if self.closed or not self.cond.wait(timeout):
+                    return []
+            items = []
+            for i in range(self.count):
+                j = (self.head + i) % self.size
+                items.append(self.slots[j])
+                self.slots[j] = None
+            self.head = (self.head + self.count) % self.size
+            self.count = 0
+            self.cond.notify_all()
+        return items
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class MidiWorker(threading.Thread):
+    """Traite les événements MIDI déposés dans le buffer d'entrée"""
+    def __init__(self, handler):
+        threading.Thread.__init__(self, name='MidiWorker', daemon=True)
+        self.handler = handler
+        # Événements traités et dont les sorties sont parties
+        self.processed = 0
+
+    def run(self):
+        ingest = self.handler.ingest
+        while not ingest.closed:
+            events = ingest.get_all()
+            with self.handler.lock:
+                for message, deltatime in events:
+                    self.handler.process(message, deltatime)
+                # Tout ce qu'a produit la rafale part ensemble
+                self.handler.flush()
+                self.processed += len(events)
+
+
+class PortWriter(threading.Thread):
+    """Écrit les messages d'un port de sortie depuis un thread dédié, par
+    priorité puis par ordre d'arrivée, au plus rate messages par milliseconde"""
+    def __init__(self, handler, destination, rate=0):
+        threading.Thread.__init__(self, name='PortWriter-%s' % destination, daemon=True)
+        self.handler = handler
+        self.destination = destination
+        # Intervalle minimum entre deux paquets USB MIDI de 3 octets, en secondes
+        self.interval = 0.001 / rate if rate else 0.0
+        self.heap = []
+        self.seq = 0
+        # Entrée en attente pour chaque LED, remplacée par un message plus récent
+        self.pending = {}
+        self.coalesced = 0
+        self.high_water = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def put(self, message, priority, key=None):
+        with self.cond:
+            if key is None:
+                # Un SysEx groupé peut recouvrir des LED en attente: les messages
+                # suivants ne doivent plus passer devant lui
+                self.pending.clear()
+            else:
+                entry = self.pending.get(key)
+                if entry is not None:
+                    entry[3] = message
+                    self.coalesced += 1
+                    return
+            entry = [priority, self.seq, key, message]
+            self.seq += 1
+            heapq.heappush(self.heap, entry)
+            if key is not None:
+                self.pending[key] = entry
+            if len(self.heap) > self.high_water:
+                self.high_water = len(self.heap)
+            self.cond.notify()
+
+    def close(self):
+        """Termine après avoir écrit les messages en attente"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.join()
+
+    def run(self):
+        next_time = time.perf_counter()
+        while True:
+            with self.cond:
+                while not self.heap and not self.closed:
+                    self.cond.wait()
+                if not self.heap:
+                    return
+                entry = heapq.heappop(self.heap)
+                key, message = entry[2], entry[3]
+                if key is not None and self.pending.get(key) is entry:
+                    del self.pending[key]
+            if self.interval:
+                delay = next_time - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                next_time = max(next_time, time.perf_counter()) + self.interval * ((len(message) + 2) // 3)
+            self.handler.write(self.destination, message)
 
 
 class MidiInputHandler(object):
     """Process incoming MIDI messages"""
-    def __init__(self, in_port, midi_channel_in, out_port, midi_channel_out, out_port2, midi_channel_out2):
+    def __init__(self, in_port, midi_channel_in, out_port, midi_channel_out, out_port2, midi_channel_out2, queue_size=0, batched_leds=True, layout=None, tracing=False, write_rate=None):
         self.in_port = in_port
-        self.midi_channel_in = int(midi_channel_in)
         self.out_port = out_port
-        self.midi_channel_out = int(midi_channel_out)
         self.out_port2 = out_port2
-        self.midi_channel_out2 = int(midi_channel_out2)
+        # Toute la traduction est faite par le moteur, ici seulement les ports
+        self.engine = BridgeEngine(midi_channel_in, midi_channel_out, midi_channel_out2,
+                                   batched_leds, layout, tracing)
+        self.ports = {LAUNCHPAD: out_port, AEOLUS: out_port2}
+        # Enregistrement facultatif de la session (voir miditrace)
+        self.recorder = None
+        self.trace_ports = {LAUNCHPAD: TRACE_PORT_LAUNCHPAD, AEOLUS: TRACE_PORT_AEOLUS}
         self._wallclock = time.time()
+        # Instant d'arrivée (perf_counter) du dernier message
+        self._arrival = time.perf_counter()
         self.in_callback = False
-        self.keydown = [False] * 128
-        self.keydowncolor = [LP_WHITE] * 128
-        self.keyupcolor = [LP_BLACK] * 128
-        self.mode_in = None
-        self.type_in = None
-        self.group_in = None
-
-    def aeolus_cc_to_note(self, group_in, stop_number):
-        y = 1 + 2 * (3 - group_in) + 1 - (stop_number // 9)
-        x = 1 + (stop_number % 9)
-        return(10 * y + x)
+        # Le moteur est aussi appelé par tick() depuis un autre thread
+        self.lock = threading.Lock()
+        # Un verrou par port de sortie: write() peut être appelé hors de
+        # self.lock (threads d'écriture) pendant qu'un port est rouvert
+        self.port_locks = {LAUNCHPAD: threading.Lock(), AEOLUS: threading.Lock()}
+        self.metrics = self.engine.metrics
+        # Mode sans perte: le callback rtmidi ne fait que remplir le
+        # buffer, un thread dédié traite les messages
+        self.ingest = None
+        self.worker = None
+        if queue_size:
+            self.ingest = MidiRingBuffer(queue_size)
+            self.worker = MidiWorker(self)
+            self.worker.start()
+        # Un thread d'écriture par port: le rythme imposé aux LED ne retarde
+        # jamais les commandes vers Aeolus
+        self.writers = None
+        if write_rate is not None:
+            self.writers = {LAUNCHPAD: PortWriter(self, LAUNCHPAD, write_rate), AEOLUS: PortWriter(self, AEOLUS)}
+            for writer in self.writers.values():
+                writer.start()
+
+    def close(self):
+        if self.ingest is not None:
+            self.ingest.close()
+            self.worker.join()
+        if self.writers is not None:
+            for writer in self.writers.values():
+                writer.close()
 
     def __call__(self, event, data=None):
+        if self.ingest is not None:
+            self.ingest.put(event)
+            return
         if self.in_callback:
+            self.metrics.dropped += 1
             logging.error('MIDI overflow')
             return
+        self.in_callback = True
         message, deltatime = event
+        with self.lock:
+            self.process(message, deltatime)
+            self.flush()
+        self.in_callback = False
+
+    def process(self, message, deltatime):
+        start = self._arrival = time.perf_counter()
         self._wallclock += deltatime
-        print("@%0.6f %r" % (self._wallclock, message))
-        self.in_callback = True
-        if message[0] == CONTROL_CHANGE + int(self.midi_channel_in):
-            # Les numéros de contrôleur utilisés par les boutons ronds
-            # de la ligne supérieure ne changent pas quel que soit le
-            # mode, c'est toujours de 68h à 6Fh
-            if 0x68 <= message[1] <= 0x6F:
-                print('Launchpad: Bouton du dessus', message[1] - 0x68, 'valeur', message[2])
-            elif message[1] == AEOLUS_CC:
-                # Ce CC provient d'Aeolus
-                if (message[2] & 0x40):
-                    # Message mode/groupe d'Aeolus
-                    self.mode_in = (message[2] >> 4) & 0x03
-                    self.group_in = message[2] & 0x07
-                    print("Aeolus: Mode", self.mode_in, "group", self.group_in)
-                    if self.mode_in == 0:
-                        # Remise à zéro du groupe
-                        self.mode_in = None
-                        print("Désactivation du groupe", self.group_in)
-                        for stop_number in range(MAX_STOPS):
-                            note = self.aeolus_cc_to_note(self.group_in, stop_number)
-                            if self.keydown[note]:
-                                self.keydown[note] = False
-                                self.out_port.send_message([NOTE_ON + self.midi_channel_out, note, self.keyupcolor[note]])
-                else:
-                    # Message de numéro de registre d'Aeolus
-                    if self.mode_in is None:
-                        logging.error("Mode non défini")
-                    else:
-                        stop_number_in = message[2] & 0x1F
-                        # Calcul de la note à partir du groupe, du mode et du registre
-                        # Ne pas tenir compte des touches absentes launchpad:
-                        # On ignore le message si le registre dépasse MAX_STOPS
-                        # ou si le groupe dépasse MAX_GROUPS
-                        if stop_number_in < MAX_STOPS and self.group_in < MAX_GROUPS:
-                            note = self.aeolus_cc_to_note(self.group_in, stop_number_in)
-                            print("Aeolus: mode", self.mode_in, "groupe", self.group_in, "registre", stop_number_in, note)
-                            if self.mode_in == 0:
-                                # Rien à faire (désactivation du groupe)
-                                v = None
-                            elif self.mode_in == 1:
-                                # Activation d'un registre
-                                v = False
-                            elif self.mode_in == 2:
-                                # Désactivation d'un registre
-                                v = True
-                            else:  # self.mode_in == 3
-                                # Inversion de l'état d'un registre
-                                v = not self.keydown[note]
-                            if v is not None and v != self.keydown[note]:
-                                self.keydown[note] = v
-                                color = self.keydowncolor[note] if self.keydown[note] else self.keyupcolor[note]
-                                self.out_port.send_message([NOTE_ON + self.midi_channel_out, note, color])
-            elif message[1] == AEOLUS_CC2:
-                # Ce nouveau CC provient d'Aeolus et définit le type
-                # d'élément du GUI, et donc sa couleur
-                # print("Aeolus type:", message[2])
-                if (message[2] & 0x40):
-                    # Message type/groupe d'Aeolus
-                    self.type_in = (message[2] >> 4) & 0x03
-                    self.group_in = message[2] & 0x07
-                    print("Aeolus: type", self.type_in, "groupe", self.group_in)
-                else:
-                    # Numéro de registre d'Aeolus
-                    if self.type_in is None:
-                        logging.error("Type non défini")
-                    else:
-                        self.stop_number_in = message[2] & 0x1F
-                        if self.stop_number_in < MAX_STOPS and self.group_in < MAX_GROUPS:
-                            note = self.aeolus_cc_to_note(self.group_in, self.stop_number_in)
-                            print("Aeolus: type", self.type_in, "groupe", self.group_in, "registre", self.stop_number_in, note)
-                            self.keyupcolor[note] = keyuptypecolor[self.type_in]
-                            self.keydowncolor[note] = keydowntypecolor[self.type_in]
-                            print("Couleurs:", self.keydowncolor[note], self.keyupcolor[note])
-                            color = self.keydowncolor[note] if self.keydown[note] else self.keyupcolor[note]
-                            self.out_port.send_message([NOTE_ON + self.midi_channel_out, note, color])
-            else:
-                logging.warning("Contrôleur MIDI inattendu: %s %s %s", message[0], message[1], message[2])
-        elif message[0] == NOTE_ON + int(self.midi_channel_in):
-            # Le launchpad est exploité en mode session
-            # Ce mode convient bien pour utiliser le launchpad comme une
-            # grille: ajouter un correspond à un déplacement d'une
-            # colonne vers la droite, ajouter 10 correspond à une ligne
-            # vers le haut
-            note = message[1]
-            y, x = divmod(note, 10)
-            print('Launchpad: Bouton colonne', x, 'ligne', y, 'valeur', message[2])
-            if message[2] == 0x7F:
-                # Appui sur le pad, changement d'état
-                self.keydown[note] = not self.keydown[note]
-                color = self.keydowncolor[note] if self.keydown[note] else self.keyupcolor[note]
-                print("Envoi vers le launchpad:", NOTE_ON + self.midi_channel_out, note, color)
-                self.out_port.send_message([NOTE_ON + self.midi_channel_out, note, color])
-                # Envoi vers Aeolus sur le deuxième port de sortie
-                mode = 2 if self.keydown[note] else 1  # action 2 pour on, 1 pour off
-                group = (8 - y) // 2  # 2 lignes par groupe à partir du haut
-                stop_number = x - 1 + (((8 - y) & 1) * 9)
-                print('Envoi vers Aeolus: mode', mode, 'groupe', group, 'registre', stop_number)
-                self.out_port2.send_message([CONTROL_CHANGE + self.midi_channel_out2, 98, 0x40 + (mode << 4) + group])
-                self.out_port2.send_message([CONTROL_CHANGE + self.midi_channel_out2, 98, stop_number])
-            else:
-                # Relachement du pad, aucun changement
-                pass
+        if self.recorder is not None:
+            self.recorder.record(self._wallclock, TRACE_IN, TRACE_PORT_IN, message)
+        self.engine.process(self._wallclock, message)
+        self.metrics.add_service_time(time.perf_counter() - start)
+
+    def clock(self):
+        """Heure courante sur l'horloge des messages entrants"""
+        return self._wallclock + time.perf_counter() - self._arrival
+
+    def tick(self):
+        """Échéances du moteur"""
+        with self.lock:
+            self.engine.tick(self.clock())
+            self.flush()
+
+    def request_dump(self):
+        """Demande à Aeolus sa configuration via la note spéciale 23"""
+        with self.lock:
+            self.engine.request_dump(self.clock())
+            self.flush()
+
+    def snapshot(self):
+        with self.lock:
+            return encode_snapshot(self.engine)
+
+    def flush(self):
+        """Envoie tout ce que le moteur a produit, Aeolus d'abord"""
+        outgoing = self.engine.flush()
+        for destination in (AEOLUS, LAUNCHPAD):
+            for message in outgoing[destination]:
+                self.send(destination, message)
+
+    def send(self, destination, message):
+        if self.writers is None:
+            self.write(destination, message)
+        elif destination == AEOLUS or message == LP_SYSEX_SESSION:
+            self.writers[destination].put(message, PRIORITY_COMMAND)
+        elif len(message) == 3:
+            # Seule la dernière couleur demandée pour une LED est envoyée
+            self.writers[destination].put(message, PRIORITY_LED, (message[0], message[1]))
         else:
-            logging.warning("Message MIDI inattendu: %s %s %s", message[0], message[1], message[2])
-        self.in_callback = False
-        return
+            self.writers[destination].put(message, PRIORITY_LED)
+
+    def write(self, destination, message):
+        if self.recorder is not None:
+            self.recorder.record(time.time(), TRACE_OUT, self.trace_ports[destination], message)
+        with self.port_locks[destination]:
+            self.ports[destination].send_message(message)
+        self.metrics.sent[destination] += 1
+
+    def repaint(self):
+        with self.lock:
+            self.engine.repaint()
+            self.flush()
 
 
 class MidiMapper:
     """Show incoming MIDI messages from launchpad"""
-    def __init__(self, port_num_in, port_num_out, midi_channel_in=0, midi_channel_out=0, midi_channel_out2=0):
+    def __init__(self, port_num_in, port_num_out, midi_channel_in=0, midi_channel_out=0, midi_channel_out2=0, queue_size=0, batched_leds=True, layout=None, tracing=False, callback=None, backend=BACKEND_RTMIDI, write_rate=None, snapshot_file=None):
         self.port_num_in = port_num_in
         self.port_num_out = port_num_out
         self.midi_channel_in = midi_channel_in
         self.midi_channel_out = midi_channel_out
         self.midi_channel_out2 = midi_channel_out2
+        # Etat de la connexion avec Aeolus, établie par main()
+        self.connected = False
+        self.launchpad_connected = True
+        self.sequencer = None
+        # Reconnexions après un débranchement (voir HotplugSupervisor)
+        self.supervisor = None
         # Nous aurons besoin de la sortie depuis l'intérieur du callback
         # Il faut donc l'initialiser en premier
+        if backend == BACKEND_ALSA:
+            self.open_alsa(port_num_in, port_num_out)
+        else:
+            self.open_rtmidi(port_num_in, port_num_out)
+        # Passe le launchpad en mode session
+        self.midiout.send_message(LP_SYSEX_SESSION)
+
+        self.handler = MidiInputHandler(
+            self.midiin, self.midi_channel_in,
+            self.midiout, self.midi_channel_out,
+            self.midiout2, self.midi_channel_out2,
+            queue_size, batched_leds, layout, tracing, write_rate)
+        # Dernier état connu, affiché sans attendre la réponse d'Aeolus
+        self.snapshot_file = snapshot_file
+        if snapshot_file is not None:
+            snapshot = snapshot_file.load()
+            if snapshot is not None:
+                self.handler.engine.restore(*snapshot)
+                logging.info("État restauré depuis %s", snapshot_file.filename)
+        # Le launchpad vient de passer en mode session: on redessine tout
+        self.repaint()
+        # Par défaut le handler est appelé directement depuis le thread d'entrée
+        self.input_callback = self.handler if callback is None else callback
+        self.midiin.set_callback(self.input_callback)
+
+    def open_rtmidi(self, port_num_in, port_num_out):
         try:
             self.midiout, self.port_name_out = open_midiport(port_num_out, 'output', interactive=False)
             logging.info("%s ouvert en sortie", self.port_name_out)
         except Exception as e:
             logging.error("Echec d'ouverture en sortie %s", e)
             sys.exit(1)
-        # Passe le launchpad en mode session
-        self.midiout.send_message([0xF0, 0x00, 0x20, 0x29, 0x02, 0x18, 0x22, 0x00, 0xF7])
 
         # Creation du deuxième port de sortie en tant que port virtuel
         try:
@@ -201,60 +393,625 @@ class MidiMapper:
 
         # Initialisation de l'entrée MIDI
         try:
-            self.midiin, self.port_name_in = open_midiport(port_num_in, 'input', interactive=False)
+            self.midiin, self.port_name_in = open_midiport(port_num_in, 'input', interactive=False,
+                                                           client_name=MIDI_IN_CLIENT)
             logging.info("%s ouvert en entrée", self.port_name_in)
             self.midiin.ignore_types(sysex=True, timing=True, active_sense=True)
-            self.midiin.set_callback(MidiInputHandler(
-                self.midiin, self.midi_channel_in,
-                self.midiout, self.midi_channel_out,
-                self.midiout2, self.midi_channel_out2))
         except Exception as e:
             logging.error("Echec d'ouverture en entrée %s", e)
             sys.exit(1)
+        # Noms sans l'adresse ALSA, qui change quand le launchpad est rebranché
+        self.launchpad_in = ADDRESS_RE.sub('', self.port_name_in).rstrip()
+        self.launchpad_out = ADDRESS_RE.sub('', self.port_name_out).rstrip()
+        # Ports à connecter avec Aeolus (voir connect_aeolus)
+        self.aeolus_ports = (MIDI_IN_CLIENT.encode(), b"to_aeolus")
+
+    def open_alsa(self, port_in, port_out):
+        """Ports de notre propre client séquenceur, abonnés au launchpad"""
+        try:
+            self.sequencer = AlsaSequencer()
+            self.midiout = self.sequencer.output_port(b"launchpad")
+            self.midiout2 = self.sequencer.output_port(b"to_aeolus")
+            self.midiin = self.sequencer.input_port()
+        except (OSError, aconnect.SequencerError) as e:
+            logging.error("Séquenceur ALSA indisponible: %s", e)
+            sys.exit(1)
+        self.port_name_out = port_out
+        if self.sequencer.connect(self.midiout.address, port_out.encode()) == 1:
+            logging.error("Echec d'ouverture en sortie %s", port_out)
+            sys.exit(1)
+        logging.info("%s ouvert en sortie", self.port_name_out)
+        self.port_name_in = port_in
+        if self.sequencer.connect(port_in.encode(), self.midiin.address) == 1:
+            logging.error("Echec d'ouverture en entrée %s", port_in)
+            sys.exit(1)
+        logging.info("%s ouvert en entrée", self.port_name_in)
+        self.aeolus_ports = (self.midiin.address, self.midiout2.address)
+
+    def repaint(self):
+        """Renvoie toutes les LED, par exemple après une reconnexion"""
+        self.handler.repaint()
+
+    def launchpad_present(self, seq):
+        """Vrai si ALSA connaît les ports du launchpad"""
+        if self.sequencer is not None:
+            return seq.port_exists(self.port_name_in.encode()) and seq.port_exists(self.port_name_out.encode())
+        return (get_midi_port_num_in(self.launchpad_in) is not None
+                and get_midi_port_num_out(self.launchpad_out) is not None)
+
+    def reopen_launchpad(self, seq):
+        """Rouvre les ports du launchpad rebranché et le redessine, renvoie False en cas d'échec"""
+        if self.sequencer is not None:
+            # Nos ports restent ouverts, seuls les abonnements ont disparu
+            if (seq.connect(self.midiout.address, self.port_name_out.encode()) == 1
+                    or seq.connect(self.port_name_in.encode(), self.midiin.address) == 1):
+                return False
+        else:
+            port_in = get_midi_port_num_in(self.launchpad_in)
+            port_out = get_midi_port_num_out(self.launchpad_out)
+            if port_in is None or port_out is None:
+                return False
+            try:
+                # Aucune écriture, quel que soit le thread, pendant le changement de port
+                with self.handler.port_locks[LAUNCHPAD]:
+                    self.midiout.close_port()
+                    self.midiout.open_port(port_out)
+                # Hors verrou: la fermeture attend la fin du callback en cours
+                self.midiin.close_port()
+                self.midiin.open_port(port_in)
+                self.midiin.ignore_types(sysex=True, timing=True, active_sense=True)
+                self.midiin.set_callback(self.input_callback)
+            except Exception as e:
+                logging.error("Echec de réouverture du launchpad: %s", e)
+                return False
+        # Le launchpad rebranché a quitté le mode session et éteint ses LED
+        self.handler.send(LAUNCHPAD, LP_SYSEX_SESSION)
+        self.repaint()
+        return True
+
+
+def format_metrics(app):
+    """Compteurs, état des registres et connexions au format texte Prometheus"""
+    if app is None:
+        # open_app() n'a pas encore rendu la main: seules les connexions,
+        # pas encore établies, ont un sens
+        return ('# TYPE lp2aeolus_connected gauge\n'
+                'lp2aeolus_connected{link="aeolus"} 0\n'
+                'lp2aeolus_connected{link="launchpad"} 0\n')
+    snapshot = app.handler.metrics.snapshot()
+    lines = ['# TYPE lp2aeolus_messages_total counter']
+    for kind, count in snapshot['messages'].items():
+        lines.append('lp2aeolus_messages_total{kind="%s"} %d' % (kind, count))
+    lines.append('# TYPE lp2aeolus_dropped_total counter')
+    lines.append('lp2aeolus_dropped_total %d' % snapshot['dropped'])
+    lines.append('# TYPE lp2aeolus_aeolus_headers_saved_total counter')
+    lines.append('lp2aeolus_aeolus_headers_saved_total %d' % app.handler.engine.encoder.saved)
+    lines.append('# TYPE lp2aeolus_sent_total counter')
+    for destination, count in snapshot['sent'].items():
+        lines.append('lp2aeolus_sent_total{port="%s"} %d' % (destination, count))
+    for name in ('service_time_us', 'ack_time_us'):
+        lines.append('# TYPE lp2aeolus_%s histogram' % name)
+        total = 0
+        for n, count in enumerate(snapshot[name].values()):
+            total += count
+            le = '+Inf' if n == len(snapshot[name]) - 1 else str(1 << n)
+            lines.append('lp2aeolus_%s_bucket{le="%s"} %d' % (name, le, total))
+        lines.append('lp2aeolus_%s_count %d' % (name, total))
+    lines.append('# TYPE lp2aeolus_ack_timeouts_total counter')
+    lines.append('lp2aeolus_ack_timeouts_total %d' % snapshot['ack_timeouts'])
+    lines.append('# TYPE lp2aeolus_ack_mismatches_total counter')
+    lines.append('lp2aeolus_ack_mismatches_total %d' % snapshot['ack_mismatches'])
+    sync = app.handler.engine.sync
+    lines.append('# TYPE lp2aeolus_sync_requests_total counter')
+    lines.append('lp2aeolus_sync_requests_total %d' % sync.requests)
+    lines.append('# TYPE lp2aeolus_sync_incomplete_total counter')
+    lines.append('lp2aeolus_sync_incomplete_total %d' % sync.incomplete)
+    if sync.duration is not None:
+        lines.append('# TYPE lp2aeolus_sync_duration_seconds gauge')
+        lines.append('lp2aeolus_sync_duration_seconds %0.6f' % sync.duration)
+    ingest = app.handler.ingest
+    if ingest is not None:
+        lines.append('# TYPE lp2aeolus_ingest_high_water gauge')
+        lines.append('lp2aeolus_ingest_high_water %d' % ingest.high_water)
+        lines.append('# TYPE lp2aeolus_ingest_overflows_total counter')
+        lines.append('lp2aeolus_ingest_overflows_total %d' % ingest.overflows)
+    writers = app.handler.writers
+    if writers is not None:
+        lines.append('# TYPE lp2aeolus_writer_high_water gauge')
+        for destination, writer in writers.items():
+            lines.append('lp2aeolus_writer_high_water{port="%s"} %d' % (destination, writer.high_water))
+        lines.append('# TYPE lp2aeolus_writer_coalesced_total counter')
+        for destination, writer in writers.items():
+            lines.append('lp2aeolus_writer_coalesced_total{port="%s"} %d' % (destination, writer.coalesced))
+    lines.append('# TYPE lp2aeolus_engaged_stops gauge')
+    state = app.handler.engine.state.copy()
+    for group in range(MAX_GROUPS):
+        lines.append('lp2aeolus_engaged_stops{group="%d"} %d' % (group, state.count(group)))
+    lines.append('# TYPE lp2aeolus_connected gauge')
+    lines.append('lp2aeolus_connected{link="aeolus"} %d' % app.connected)
+    lines.append('lp2aeolus_connected{link="launchpad"} %d' % app.launchpad_connected)
+    supervisor = app.supervisor
+    if supervisor is not None:
+        lines.append('# TYPE lp2aeolus_disconnects_total counter')
+        for link, count in supervisor.losses.items():
+            lines.append('lp2aeolus_disconnects_total{link="%s"} %d' % (link, count))
+        for name, values in (('recover', supervisor.recover_time), ('downtime', supervisor.downtime)):
+            lines.append('# TYPE lp2aeolus_%s_seconds gauge' % name)
+            for link, seconds in values.items():
+                if seconds is not None:
+                    lines.append('lp2aeolus_%s_seconds{link="%s"} %0.6f' % (name, link, seconds))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        self.wfile.write(format_metrics(self.server.app).encode())
+
+
+class MetricsServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serveur de métriques sur socket Unix, hors du thread MIDI"""
+    daemon_threads = True
+
+    def __init__(self, path, app):
+        self.path = path
+        self.app = app
+        # Socket d'une exécution précédente
+        if os.path.exists(path):
+            os.unlink(path)
+        socketserver.UnixStreamServer.__init__(self, path, MetricsRequestHandler)
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class PortRegistry(object):
+    """Ports MIDI ALSA énumérés une seule fois, indexés par nom et par client:port"""
+    def __init__(self):
+        self.midiin = None
+        self.midiout = None
+        self.lock = threading.Lock()
+        self.valid = False
+        # Sans surveillance des annonces, chaque recherche énumère les ports
+        self.watched = False
+        self.names = {'input': [], 'output': []}
+        self.by_client = {'input': {}, 'output': {}}
+        self.by_address = {'input': {}, 'output': {}}
+
+    def invalidate(self, *event):
+        self.valid = False
+
+    def watch(self, watcher):
+        """N'énumère à nouveau qu'après l'annonce d'un client ou d'un port ALSA"""
+        def on_announce(event_type, client, port):
+            if aconnect.SND_SEQ_EVENT_CLIENT_START <= event_type <= aconnect.SND_SEQ_EVENT_PORT_CHANGE:
+                self.invalidate()
+        watcher.add_listener(on_announce)
+        self.watched = True
+
+    def refresh(self):
+        if self.midiin is None:
+            self.midiin = MidiIn(API_LINUX_ALSA, REGISTRY_CLIENT)
+            self.midiout = MidiOut(API_LINUX_ALSA, REGISTRY_CLIENT)
+        # Marqué valide avant l'énumération: une annonce pendant celle-ci
+        # provoquera une nouvelle énumération
+        self.valid = True
+        for direction, midi in (('input', self.midiin), ('output', self.midiout)):
+            names = midi.get_ports()
+            by_client = {}
+            by_address = {}
+            for p_num, p in enumerate(names):
+                by_client.setdefault(p.split(':')[0], p_num)
+                m = ADDRESS_RE.search(p)
+                if m:
+                    by_address[(int(m.group(1)), int(m.group(2)))] = p_num
+            self.names[direction] = names
+            self.by_client[direction] = by_client
+            self.by_address[direction] = by_address
+
+    def ports(self, direction):
+        with self.lock:
+            if not (self.valid and self.watched):
+                self.refresh()
+            return self.names[direction]
+
+    def find(self, direction, s):
+        """Numéro du premier port dont le nom commence par s, ou d'adresse s='client:port'"""
+        with self.lock:
+            if not (self.valid and self.watched):
+                self.refresh()
+            m = ADDRESS_RE.match(s)
+            if m:
+                return self.by_address[direction].get((int(m.group(1)), int(m.group(2))))
+            p_num = self.by_client[direction].get(s)
+            if p_num is not None:
+                return p_num
+            for p_num, p in enumerate(self.names[direction]):
+                if p.startswith(s):
+                    return(p_num)
+            return(None)
+
+
+midi_ports = PortRegistry()
 
 
 def list_midi_ports():
     """ Imprime une liste des ports MIDI Alsa"""
     if API_LINUX_ALSA in get_compiled_api():
         print('Input:')
-        for p in MidiIn(API_LINUX_ALSA).get_ports():
+        for p in midi_ports.ports('input'):
             print(p)
         print('Output:')
-        for p in MidiOut(API_LINUX_ALSA).get_ports():
+        for p in midi_ports.ports('output'):
             print(p)
     else:
         print('Ce programme nécessite Alsa')
 
 
 def get_midi_port_num_in(s):
-    p_num = 0
-    for p in MidiIn(API_LINUX_ALSA).get_ports():
-        if p.startswith(s):
-            return(p_num)
-        p_num += 1
-    return(None)
+    return midi_ports.find('input', s)
 
 
 def get_midi_port_num_out(s):
-    p_num = 0
-    for p in MidiOut(API_LINUX_ALSA).get_ports():
-        if p.startswith(s):
-            return(p_num)
-        p_num += 1
-    return(None)
+    return midi_ports.find('output', s)
+
+
+def connect_aeolus(seq, midi_in=MIDI_IN_CLIENT.encode(), to_aeolus=b"to_aeolus"):
+    """Connecte Aeolus dans les deux sens, renvoie False en cas d'échec"""
+    connected = True
+    # aeolus:Out KO avec Aeolus 0.9.5f ??
+    # fonctionne avec 129:1 et avec aeolus:1
+    # pb de gestion du nom/du numéro à l'ouverture du port dans Aeolus?
+    # pq les deux ports aeolus ont-ils le même numéro (132:0 et 132:1)
+    if (seq.connect(b"aeolus:1", midi_in) == 1):
+        logging.error("Echec de connection depuis Aeolus")
+        connected = False
+    if (seq.connect(to_aeolus, b"aeolus:In") == 1):
+        logging.error("Echec de connection vers Aeolus")
+        connected = False
+    return connected
+
+
+def start_aeolus(startup_timeout=AEOLUS_STARTUP_TIMEOUT, midi_in=MIDI_IN_CLIENT.encode(), to_aeolus=b"to_aeolus"):
+    """Connecte Aeolus, en le démarrant si besoin; renvoie l'état de la connexion"""
+    # Une seule session séquenceur pour toutes les connexions
+    try:
+        with aconnect.SequencerSession() as seq:
+            connected = connect_aeolus(seq, midi_in, to_aeolus)
+            if not connected:
+                logging.info("Démarrage de Aeolus...")
+                try:
+                    Popen("aeolus")
+                except OSError as e:
+                    logging.error("Impossible de démarrer Aeolus: %s", e)
+                    return False
+                # On réagit dès qu'ALSA annonce les ports d'Aeolus
+                delay = seq.wait_for_ports([b"aeolus:In", b"aeolus:1"], startup_timeout)
+                if delay is None:
+                    logging.error("Aeolus n'est pas prêt après %0.1f s", startup_timeout)
+                else:
+                    logging.info("Aeolus prêt en %0.3f s", delay)
+                    connected = connect_aeolus(seq, midi_in, to_aeolus)
+    except (OSError, aconnect.SequencerError) as e:
+        logging.error("Séquenceur ALSA indisponible: %s", e)
+        connected = False
+    return connected
+
+
+def request_dump(app):
+    app.handler.request_dump()
+
+
+class HotplugSupervisor(threading.Thread):
+    """Reconnecte le launchpad et Aeolus quand ALSA annonce leur retour,
+    sans redémarrer le bridge"""
+    def __init__(self, app, watcher):
+        threading.Thread.__init__(self, name='HotplugSupervisor', daemon=True)
+        self.app = app
+        # Session propre au thread pour les vérifications et les abonnements
+        self.session = aconnect.SequencerSession(b"lp2aeolus supervisor")
+        now = time.perf_counter()
+        # Instant de la perte de chaque lien, None s'il est en place
+        self.lost_at = {LAUNCHPAD: None, AEOLUS: None if app.connected else now}
+        self.losses = {LAUNCHPAD: 0, AEOLUS: 0}
+        # Dernière reconnexion: délai depuis l'annonce du retour, durée de la coupure
+        self.recover_time = {LAUNCHPAD: None, AEOLUS: None}
+        self.downtime = {LAUNCHPAD: None, AEOLUS: None}
+        self.cond = threading.Condition()
+        # Première vérification sans attendre: Aeolus a pu démarrer entre-temps
+        self.announced_at = now
+        self.stopped = False
+        watcher.add_listener(self.on_announce)
+
+    def on_announce(self, event_type, client, port):
+        """Appelé depuis le thread de surveillance des annonces"""
+        if event_type in (aconnect.SND_SEQ_EVENT_CLIENT_START, aconnect.SND_SEQ_EVENT_CLIENT_EXIT,
+                          aconnect.SND_SEQ_EVENT_PORT_START, aconnect.SND_SEQ_EVENT_PORT_EXIT):
+            with self.cond:
+                if self.announced_at is None:
+                    self.announced_at = time.perf_counter()
+                    self.cond.notify()
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        self.join()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.announced_at is None and not self.stopped:
+                    self.cond.wait()
+                if self.stopped:
+                    break
+            time.sleep(HOTPLUG_SETTLE)
+            with self.cond:
+                announced_at, self.announced_at = self.announced_at, None
+            try:
+                self.check(announced_at)
+            except aconnect.SequencerError as e:
+                logging.error("Séquenceur ALSA: %s", e)
+        self.session.close()
+
+    def lose(self, link, announced_at):
+        self.lost_at[link] = announced_at
+        self.losses[link] += 1
+        logging.warning("Connexion perdue: %s", link)
+
+    def recovered(self, link, announced_at):
+        now = time.perf_counter()
+        self.recover_time[link] = now - announced_at
+        self.downtime[link] = now - self.lost_at[link]
+        self.lost_at[link] = None
+        logging.warning("Connexion rétablie: %s en %0.3f s (coupure de %0.1f s)", link, self.recover_time[link],
+                        self.downtime[link])
+
+    def check(self, announced_at):
+        """Compare les ports annoncés aux liens en place"""
+        app = self.app
+        seq = self.session
+        launchpad = app.launchpad_present(seq)
+        aeolus = seq.port_exists(b"aeolus:In") and seq.port_exists(b"aeolus:1")
+        if self.lost_at[LAUNCHPAD] is None and not launchpad:
+            app.launchpad_connected = False
+            self.lose(LAUNCHPAD, announced_at)
+        if self.lost_at[AEOLUS] is None and not aeolus:
+            app.connected = False
+            self.lose(AEOLUS, announced_at)
+        if self.lost_at[LAUNCHPAD] is not None and launchpad and app.reopen_launchpad(seq):
+            app.launchpad_connected = True
+            self.recovered(LAUNCHPAD, announced_at)
+            if app.sequencer is None and self.lost_at[AEOLUS] is None:
+                # Nouveau port d'entrée rtmidi: l'abonnement depuis Aeolus est à refaire
+                seq.connect(b"aeolus:1", app.aeolus_ports[0])
+        if self.lost_at[AEOLUS] is not None and aeolus and connect_aeolus(seq, *app.aeolus_ports):
+            app.connected = True
+            with app.handler.lock:
+                app.handler.engine.aeolus_connected()
+            # Aeolus redémarré a pu changer d'état: tout lui redemander
+            request_dump(app)
+            self.recovered(AEOLUS, announced_at)
+
+
+def start_supervisor(app, watcher):
+    """Surveille les débranchements, seulement si les annonces ALSA sont disponibles"""
+    if watcher is None:
+        logging.warning("Pas de reconnexion automatique sans annonces ALSA")
+        return
+    try:
+        app.supervisor = HotplugSupervisor(app, watcher)
+    except (OSError, aconnect.SequencerError) as e:
+        logging.warning("Pas de reconnexion automatique: %s", e)
+        return
+    app.supervisor.start()
+
+
+def open_app(input_port=None, output_port=None, channel=0, queue_size=0, batched_leds=True, layout=None,
+             tracing=False, record_file=None, callback=None, backend=BACKEND_RTMIDI, write_rate=None,
+             state_file=None):
+    """Trouve le launchpad et ouvre tous les ports MIDI"""
+    s = 'Launchpad MK2'
+    if backend == BACKEND_ALSA:
+        # Nom de client ou adresse client:port, résolus par le séquenceur
+        if input_port is None:
+            input_port = s
+        if output_port is None:
+            output_port = s
+    else:
+        input_port, output_port = find_rtmidi_ports(input_port, output_port, s)
+
+    snapshot_file = None if state_file is None else SnapshotFile(state_file)
+    app = MidiMapper(port_num_in=input_port, port_num_out=output_port, midi_channel_in=channel, midi_channel_out=channel, midi_channel_out2=channel, queue_size=queue_size, batched_leds=batched_leds, layout=layout, tracing=tracing, callback=callback, backend=backend, write_rate=write_rate, snapshot_file=snapshot_file)
+
+    if record_file is not None:
+        app.handler.recorder = TraceRecorder(record_file)
+    return app
+
+
+def find_rtmidi_ports(input_port, output_port, s):
+    """Numéros des ports rtmidi, le launchpad s par défaut"""
+    # Les ports peuvent être donnés par leur adresse ALSA client:port
+    if input_port is not None and ADDRESS_RE.match(input_port):
+        input_port = get_midi_port_num_in(input_port)
+    if output_port is not None and ADDRESS_RE.match(output_port):
+        output_port = get_midi_port_num_out(output_port)
+
+    # Cherche le launchpad si les ports ne sont pas donnés via -i et -o
+    if input_port is None:
+        input_port = get_midi_port_num_in(s)
+        if input_port is not None:
+            logging.info('Trouvé %s en entrée: %d', s, input_port)
+    if output_port is None:
+        output_port = get_midi_port_num_out(s)
+        if output_port is not None:
+            logging.info('Trouvé %s en sortie: %d', s, output_port)
+    return input_port, output_port
+
+
+def toggle_trace(app):
+    engine = app.handler.engine
+    engine.tracing = not engine.tracing
+    logging.warning("Trace MIDI %s", "activée" if engine.tracing else "désactivée")
+
+
+def log_metrics(app):
+    logging.warning("Métriques: %r", app.handler.metrics.snapshot())
+
+
+def save_snapshot(app):
+    if app.snapshot_file is not None:
+        app.snapshot_file.save(app.handler.snapshot())
+
+
+def close_app(app):
+    if app.supervisor is not None:
+        app.supervisor.stop()
+    if app.sequencer is not None:
+        app.midiin.close()
+    save_snapshot(app)
+    app.handler.close()
+    if app.handler.recorder is not None:
+        app.handler.recorder.close()
+    if app.handler.ingest is not None:
+        logging.info("Buffer d'entrée: maximum %d sur %d, débordements %d", app.handler.ingest.high_water,
+                     app.handler.ingest.size, app.handler.ingest.overflows)
+    if app.sequencer is not None:
+        app.sequencer.close()
+
+
+class AsyncBridge(object):
+    """Démarrage, minuteries et signaux dans une boucle asyncio; le callback
+    rtmidi ne fait que poster les événements MIDI dans la boucle"""
+    def __init__(self, startup_timeout=AEOLUS_STARTUP_TIMEOUT, watcher=None):
+        self.startup_timeout = startup_timeout
+        self.watcher = watcher
+        self.loop = None
+        self.app = None
+        self.stopped = None
+        self.flush_pending = False
+        self.ticker = None
+        # Événements arrivés avant la fin de open_app()
+        self.early = []
+
+    def callback(self, event, data=None):
+        """Appelé par rtmidi depuis son thread"""
+        try:
+            self.loop.call_soon_threadsafe(self.on_midi, event)
+        except RuntimeError:
+            # Boucle déjà fermée
+            pass
+
+    def on_midi(self, event):
+        if self.app is None:
+            self.early.append(event)
+            return
+        message, deltatime = event
+        handler = self.app.handler
+        # Le superviseur peut changer les ports depuis son thread
+        with handler.lock:
+            handler.process(message, deltatime)
+        # Un seul envoi pour tous les événements déjà dans la boucle
+        if not self.flush_pending:
+            self.flush_pending = True
+            self.loop.call_soon(self.flush)
+
+    def flush(self):
+        self.flush_pending = False
+        with self.app.handler.lock:
+            self.app.handler.flush()
+
+    def stop(self, signum=None):
+        if signum == signal.SIGINT:
+            print('\nInterrompu par l\'utilisateur')
+        self.stopped.set()
+
+    async def sync(self):
+        """Envoie la note 23 et attend la fin de la réponse d'Aeolus, nouvelles
+        demandes comprises; la fin est constatée par tick_loop()"""
+        sync = self.app.handler.engine.sync
+        request_dump(self.app)
+        while sync.active:
+            await asyncio.sleep(TICK_PERIOD)
+        return sync.complete
+
+    async def startup(self, open_args):
+        # Énumération ALSA et attente d'Aeolus bloquent: hors de la boucle
+        app = await self.loop.run_in_executor(None, functools.partial(open_app, callback=self.callback, **open_args))
+        self.app = app
+        early, self.early = self.early, []
+        for event in early:
+            self.on_midi(event)
+        self.loop.add_signal_handler(signal.SIGUSR2, toggle_trace, app)
+        self.loop.add_signal_handler(signal.SIGUSR1, log_metrics, app)
+        self.ticker = self.loop.create_task(self.tick_loop())
+        app.connected = await self.loop.run_in_executor(None, start_aeolus, self.startup_timeout, *app.aeolus_ports)
+        app.handler.engine.aeolus_connected()
+        if not app.connected:
+            await self.loop.run_in_executor(None, list_midi_ports)
+        await self.loop.run_in_executor(None, start_supervisor, app, self.watcher)
+        await self.sync()
+        logging.info('En attente de message MIDI')
+
+    async def tick_loop(self):
+        while True:
+            await asyncio.sleep(TICK_PERIOD)
+            self.app.handler.tick()
+            save_snapshot(self.app)
+
+    def on_startup_done(self, task):
+        # Un échec du démarrage termine aussi la boucle
+        if not task.cancelled() and task.exception() is not None:
+            self.stopped.set()
+
+    async def serve_metrics(self, reader, writer):
+        writer.write(format_metrics(self.app).encode())
+        await writer.drain()
+        writer.close()
+
+    async def run(self, open_args, metrics_path=None):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            self.loop.add_signal_handler(signum, self.stop, signum)
+        server = None
+        startup = self.loop.create_task(self.startup(open_args))
+        startup.add_done_callback(self.on_startup_done)
+        try:
+            if metrics_path is not None:
+                if os.path.exists(metrics_path):
+                    os.unlink(metrics_path)
+                server = await asyncio.start_unix_server(self.serve_metrics, metrics_path)
+            await self.stopped.wait()
+        finally:
+            if not startup.done():
+                startup.cancel()
+            if self.ticker is not None:
+                self.ticker.cancel()
+            if self.app is not None:
+                self.app.midiin.cancel_callback()
+            if server is not None:
+                server.close()
+                await server.wait_closed()
+                if os.path.exists(metrics_path):
+                    os.unlink(metrics_path)
+        if not startup.cancelled() and startup.exception() is not None:
+            raise startup.exception()
 
 
 def main(argv=None):
 
     def usage():
-        print(sys.argv[0], "-h -l -i port -o port -c channel -v")
+        print(sys.argv[0], "-h -l -i port -o port -c channel -q taille -n -g fichier -t -w secondes -r fichier -m socket -a -b backend -p messages/ms -s fichier -v")
 
     if argv is None:
         argv = sys.argv
     try:
         opts, args = getopt.getopt(sys.argv[1:],
-            "hli:o:c:v",
-            ["help", "list", "input=", "output=", "channel=", "verbose"])
+            "hli:o:c:q:ng:tw:r:m:ab:p:s:v",
+            ["help", "list", "input=", "output=", "channel=", "queue=", "no-batch", "grid=", "trace", "wait=", "record=",
+             "metrics=", "asyncio", "backend=", "pace=", "state=", "verbose"])
     except getopt.GetoptError as err:
         # Affiche l'aide et sort
         print(str(err))  # Imprimera quelque chose comme "option -a not recognized"
@@ -264,10 +1021,20 @@ def main(argv=None):
     input_port = None
     output_port = None
     verbose = False
+    tracing = False
     channel = 0
+    queue_size = 0
+    batched_leds = True
+    layout = None
+    startup_timeout = AEOLUS_STARTUP_TIMEOUT
+    record_file = None
+    metrics_path = None
+    use_asyncio = False
+    backend = BACKEND_RTMIDI
+    write_rate = None
+    state_file = None
     for o, a in opts:
         if o == "-v":
-            logging.basicConfig(level=logging.INFO)
             verbose = True
         elif o in ("-h", "--help"):
             usage()
@@ -281,58 +1048,108 @@ def main(argv=None):
             input_port = a
         elif o in ("-c", "--channel"):
             channel = a
+        elif o in ("-q", "--queue"):
+            # Mode sans perte avec un buffer d'entrée de cette taille
+            queue_size = int(a)
+        elif o in ("-n", "--no-batch"):
+            # Une note par LED au lieu d'un SysEx groupé
+            batched_leds = False
+        elif o in ("-g", "--grid"):
+            # Disposition des registres sur la grille
+            layout = GridLayout.load(a)
+        elif o in ("-t", "--trace"):
+            # Trace des messages MIDI, basculable ensuite par SIGUSR2
+            tracing = True
+        elif o in ("-w", "--wait"):
+            # Délai maximum de démarrage d'Aeolus
+            startup_timeout = float(a)
+        elif o in ("-r", "--record"):
+            # Enregistrement de tous les messages MIDI
+            record_file = a
+        elif o in ("-m", "--metrics"):
+            # Socket Unix des métriques
+            metrics_path = a
+        elif o in ("-a", "--asyncio"):
+            # Boucle asyncio au lieu du callback rtmidi direct
+            use_asyncio = True
+        elif o in ("-b", "--backend"):
+            # rtmidi, ou alsa pour lire et écrire directement le séquenceur
+            if a not in (BACKEND_RTMIDI, BACKEND_ALSA):
+                usage()
+                sys.exit(2)
+            backend = a
+        elif o in ("-p", "--pace"):
+            # Threads d'écriture, LED limitées à ce nombre de messages par ms (0: sans limite)
+            write_rate = float(a)
+        elif o in ("-s", "--state"):
+            # Instantané de l'état, relu au démarrage et mis à jour à chaque changement
+            state_file = a
         else:
             assert False, "option non reconnue"
 
-    # Cherche le launchpad si les ports ne sont pas donnés via -i et -o
-    s = 'Launchpad MK2'
-    if input_port is None:
-        input_port = get_midi_port_num_in(s)
-        if input_port is not None:
-            print('Trouvé', s, 'en entrée:', input_port)
-    if output_port is None:
-        output_port = get_midi_port_num_out(s)
-        if output_port is not None:
-            print('Trouvé', s, 'en sortie:', output_port)
+    listener = setup_logging(logging.INFO if verbose else logging.WARNING)
+    atexit.register(listener.stop)
+
+    # Les ports ne sont énumérés à nouveau qu'après une annonce ALSA
+    try:
+        watcher = aconnect.AnnounceWatcher()
+        midi_ports.watch(watcher)
+        watcher.start()
+    except (OSError, aconnect.SequencerError) as e:
+        logging.warning("Annonces ALSA indisponibles: %s", e)
+        watcher = None
+
+    open_args = dict(input_port=input_port, output_port=output_port, channel=channel, queue_size=queue_size,
+                     batched_leds=batched_leds, layout=layout, tracing=tracing, record_file=record_file,
+                     backend=backend, write_rate=write_rate, state_file=state_file)
+    if use_asyncio:
+        # La boucle remplace le buffer d'entrée et son worker
+        open_args['queue_size'] = 0
+        bridge = AsyncBridge(startup_timeout, watcher)
+        try:
+            asyncio.run(bridge.run(open_args, metrics_path))
+        finally:
+            if bridge.app is not None:
+                close_app(bridge.app)
+            if watcher is not None:
+                watcher.stop()
+        print('Fini')
+        return
 
-    app = MidiMapper(port_num_in=input_port, port_num_out=output_port, midi_channel_in=channel, midi_channel_out=channel, midi_channel_out2=channel)
+    app = open_app(**open_args)
+
+    signal.signal(signal.SIGUSR2, lambda signum, frame: toggle_trace(app))
+    signal.signal(signal.SIGUSR1, lambda signum, frame: log_metrics(app))
 
     # Tente de se connecter avec Aeolus dans les deux sens
-    connected = True
-    # aeolus:Out KO avec Aeolus 0.9.5f ??
-    # fonctionne avec 129:1 et avec aeolus:1
-    # pb de gestion du nom/du numéro à l'ouverture du port dans Aeolus?
-    # pq les deux ports aeolus ont-ils le même numéro (132:0 et 132:1)
-    if (aconnect.aconnect(b"aeolus:1", b"RtMidiIn Client") == 1):
-        logging.error("Echec de connection depuis Aeolus")
-        connected = False
-    if (aconnect.aconnect(b"to_aeolus", b"aeolus:In") == 1):
-        logging.error("Echec de connection vers Aeolus")
-        connected = False
-    if not connected:
-        print("Démarrage de Aeolus...")
-        Popen("aeolus")
-        time.sleep(1)
-        connected = True
-        if (aconnect.aconnect(b"aeolus:1", b"RtMidiIn Client") == 1):
-            logging.error("Echec de connection depuis Aeolus")
-            connected = False
-        if (aconnect.aconnect(b"to_aeolus", b"aeolus:In") == 1):
-            logging.error("Echec de connection vers Aeolus")
-            connected = False
-    if not connected:
+    app.connected = start_aeolus(startup_timeout, *app.aeolus_ports)
+    app.handler.engine.aeolus_connected()
+    if not app.connected:
         list_midi_ports()
 
-    # Demande à Aeolus sa configuration via la note spéciale 23
-    print("Envoi de", [NOTE_ON + app.midi_channel_out, 23, 127])
-    app.midiout2.send_message([NOTE_ON + app.midi_channel_out, 23, 127])
+    request_dump(app)
+    start_supervisor(app, watcher)
 
-    print('En attente de message MIDI')
+    logging.info('En attente de message MIDI')
+    server = None
+    if metrics_path is not None:
+        # Les demandes de métriques sont servies par un thread dédié
+        server = MetricsServer(metrics_path, app)
+        threading.Thread(target=server.serve_forever, name='MetricsServer', daemon=True).start()
     try:
+        # Le thread principal ne fait que vérifier les échéances
         while True:
-            time.sleep(1)
+            time.sleep(TICK_PERIOD)
+            app.handler.tick()
+            save_snapshot(app)
     except KeyboardInterrupt:
         print('\nInterrompu par l\'utilisateur')
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+    close_app(app)
+    if watcher is not None:
+        watcher.stop()
     print('Fini')
 
 
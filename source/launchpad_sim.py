@@ -0,0 +1,99 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# Launchpad MK2 simulé: capture des LED et injection d'appuis sur les pads
+
+import time
+
+from bridge import (CONTROL_CHANGE, LP_SYSEX_HEADER, LP_SYSEX_SESSION, LP_SYSEX_SET_LEDS, LP_TOP_FIRST, LP_TOP_ROW,
+                    LP_UNKNOWN, NOTE_ON)
+
+# Dernier contrôleur des boutons ronds de la ligne supérieure
+LP_TOP_LAST = LP_TOP_ROW[-1]
+
+
+class LaunchpadSimulator(object):
+    """Reçoit ce que le bridge envoie au launchpad et génère des appuis"""
+    def __init__(self, midi_channel=0, clock=time.perf_counter):
+        self.midi_channel = midi_channel
+        self.clock = clock
+        self.session = False
+        # Couleur de chaque LED, indexée comme les SysEx du MK2: notes 11 à 89
+        # pour la grille et la colonne de droite, 104 à 111 pour la ligne du haut
+        self.leds = bytearray([LP_UNKNOWN] * 128)
+        self.writes = 0
+        self.redundant_writes = 0
+        self.messages = 0
+        # Instant du dernier appui non encore suivi d'un changement de LED
+        self.pressed_at = {}
+        # Délais appui -> LED, en secondes
+        self.latencies = []
+
+    # Côté sortie du bridge: se comporte comme un port rtmidi
+    def send_message(self, message):
+        self.messages += 1
+        if message == LP_SYSEX_SESSION:
+            self.session = True
+        elif message[:7] == LP_SYSEX_HEADER + [LP_SYSEX_SET_LEDS] and message[-1] == 0xF7:
+            for i in range(7, len(message) - 1, 2):
+                self.set_led(message[i], message[i + 1])
+        elif message[0] == NOTE_ON + self.midi_channel:
+            self.set_led(message[1], message[2])
+        elif message[0] == CONTROL_CHANGE + self.midi_channel and LP_TOP_FIRST <= message[1] <= LP_TOP_LAST:
+            self.set_led(message[1], message[2])
+
+    def set_led(self, index, color):
+        self.writes += 1
+        if self.leds[index] == color:
+            self.redundant_writes += 1
+        self.leds[index] = color
+        pressed = self.pressed_at.pop(index, None)
+        if pressed is not None:
+            self.latencies.append(self.clock() - pressed)
+
+    def frame(self):
+        """Ligne du haut puis les 8 lignes de la grille de haut en bas,
+        chaque ligne de la grille suivie du bouton de droite"""
+        rows = [list(self.leds[LP_TOP_FIRST:LP_TOP_LAST + 1])]
+        for y in range(8, 0, -1):
+            rows.append(list(self.leds[10 * y + 1:10 * y + 10]))
+        return rows
+
+    # Côté entrée du bridge: messages émis par les pads
+    def press(self, x, y):
+        note = 10 * y + x
+        self.pressed_at[note] = self.clock()
+        return [NOTE_ON + self.midi_channel, note, 0x7F]
+
+    def release(self, x, y):
+        return [NOTE_ON + self.midi_channel, 10 * y + x, 0]
+
+    def top(self, n, value=0x7F):
+        return [CONTROL_CHANGE + self.midi_channel, LP_TOP_FIRST + n, value]
+
+    def play(self, callback, actions, rate=None):
+        """Appelle callback((message, deltatime)) comme rtmidi pour chaque action,
+        à rate messages par seconde au plus (sans limite si rate est None)"""
+        period = 1.0 / rate if rate else 0.0
+        last = self.clock()
+        next_time = last
+        for action, args in actions:
+            if period:
+                delay = next_time - self.clock()
+                if delay > 0:
+                    time.sleep(delay)
+                next_time += period
+            message = getattr(self, action)(*args)
+            now = self.clock()
+            callback((message, now - last))
+            last = now
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+        n = len(latencies)
+        return {
+            'messages': self.messages,
+            'led_writes': self.writes,
+            'redundant_led_writes': self.redundant_writes,
+            'press_to_led_p50_us': latencies[n // 2] * 1e6 if n else 0.0,
+            'press_to_led_max_us': latencies[-1] * 1e6 if n else 0.0,
+        }
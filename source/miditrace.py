@@ -0,0 +1,157 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# Enregistrement et relecture des sessions MIDI dans un format binaire compact
+
+import sys
+import getopt
+import mmap
+import struct
+import threading
+import time
+
+from bridge import BridgeEngine
+
+TRACE_MAGIC = b'LP2ATRC\x00'
+TRACE_VERSION = 1
+# En-tête: signature, version, taille d'un enregistrement
+TRACE_HEADER = struct.Struct('<8sHH4x')
+# Enregistrement de taille fixe: horodatage, sens, port, longueur, 4 octets.
+# Un message plus long (SysEx) est suivi de ses octets, complétés par des zéros
+# jusqu'à un multiple de la taille d'un enregistrement
+TRACE_RECORD = struct.Struct('<dBBH4s')
+TRACE_INLINE = 4
+
+# Sens du message
+TRACE_IN = 0
+TRACE_OUT = 1
+# Ports: entrée du bridge, sortie launchpad, sortie to_aeolus
+TRACE_PORT_IN = 0
+TRACE_PORT_LAUNCHPAD = 1
+TRACE_PORT_AEOLUS = 2
+
+
+class TraceRecorder(object):
+    """Écrit chaque message entrant ou sortant dans un fichier de trace"""
+    def __init__(self, filename):
+        self.f = open(filename, 'wb')
+        self.f.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, TRACE_RECORD.size))
+        # Appelé depuis le thread MIDI et depuis main()
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def record(self, timestamp, direction, port, message):
+        data = bytes(message)
+        n = len(data)
+        with self.lock:
+            if n <= TRACE_INLINE:
+                self.f.write(TRACE_RECORD.pack(timestamp, direction, port, n, data))
+            else:
+                self.f.write(TRACE_RECORD.pack(timestamp, direction, port, n, b''))
+                padding = -n % TRACE_RECORD.size
+                self.f.write(data + b'\x00' * padding)
+            self.count += 1
+
+    def close(self):
+        with self.lock:
+            self.f.close()
+
+
+class TraceReader(object):
+    """Lit un fichier de trace projeté en mémoire"""
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, record_size = TRACE_HEADER.unpack_from(self.map, 0)
+        if magic != TRACE_MAGIC or version != TRACE_VERSION or record_size != TRACE_RECORD.size:
+            self.map.close()
+            raise ValueError("Fichier de trace invalide: %s" % filename)
+
+    def __iter__(self):
+        """(horodatage, sens, port, message) pour chaque enregistrement"""
+        m = self.map
+        offset = TRACE_HEADER.size
+        size = TRACE_RECORD.size
+        end = len(m)
+        while offset + size <= end:
+            timestamp, direction, port, n, data = TRACE_RECORD.unpack_from(m, offset)
+            offset += size
+            if n <= TRACE_INLINE:
+                message = list(data[:n])
+            else:
+                message = list(m[offset:offset + n])
+                offset += n + (-n % size)
+            yield timestamp, direction, port, message
+
+    def close(self):
+        self.map.close()
+
+    def replay(self, callback, realtime=False):
+        """Rejoue les messages entrants vers callback((message, deltatime)) comme
+        rtmidi, au rythme d'origine ou aussi vite que possible"""
+        count = 0
+        last = None
+        start = time.perf_counter()
+        first = None
+        for timestamp, direction, port, message in self:
+            if direction != TRACE_IN:
+                continue
+            if last is None:
+                first = timestamp
+                last = timestamp
+            if realtime:
+                delay = (timestamp - first) - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            callback((message, timestamp - last))
+            last = timestamp
+            count += 1
+        return count
+
+
+def main(argv=None):
+
+    def usage():
+        print(sys.argv[0], "-h -l -r fichier")
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "hlr", ["help", "list", "realtime"])
+    except getopt.GetoptError as err:
+        print(str(err))
+        usage()
+        sys.exit(2)
+    listing = False
+    realtime = False
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit()
+        elif o in ("-l", "--list"):
+            listing = True
+        elif o in ("-r", "--realtime"):
+            realtime = True
+    if len(args) != 1:
+        usage()
+        sys.exit(2)
+    reader = TraceReader(args[0])
+    if listing:
+        for timestamp, direction, port, message in reader:
+            print("@%0.6f %s %d %r" % (timestamp, "<" if direction == TRACE_IN else ">", port, message))
+    else:
+        # Relecture dans le moteur, sans ports MIDI
+        engine = BridgeEngine()
+        clock = [0.0]
+
+        def process(event):
+            message, deltatime = event
+            clock[0] += deltatime
+            engine.process(clock[0], message)
+            engine.flush()
+        start = time.perf_counter()
+        count = reader.replay(process, realtime)
+        elapsed = time.perf_counter() - start
+        print("%d messages en %0.3f s (%0.0f messages/s)" % (count, elapsed, count / elapsed if elapsed else 0.0))
+    reader.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+# Dernier état connu du bridge, conservé entre deux exécutions
+
+import logging
+import os
+import struct
+
+from bridge import LP_TOP_ROW, StopState
+
+SNAPSHOT_MAGIC = b'LP2ASNP\x00'
+SNAPSHOT_VERSION = 1
+# En-tête: signature, version
+SNAPSHOT_HEADER = struct.Struct('<8sH6x')
+# Masques des registres enclenchés par groupe, couleurs des pads relâchés et enfoncés
+SNAPSHOT_STATE = struct.Struct('<8I128s128s')
+# Registrations des boutons du dessus: bit n si le bouton n en a une, puis 8 masques par bouton
+SNAPSHOT_PRESETS = struct.Struct('<B7x%dI' % (8 * len(LP_TOP_ROW)))
+
+
+def encode(engine):
+    """Instantané binaire de l'état du moteur"""
+    state = engine.state
+    present = 0
+    masks = []
+    for n, preset in enumerate(engine.presets):
+        if preset is not None:
+            present |= 1 << n
+        masks.extend(preset if preset is not None else [0] * 8)
+    return (SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION)
+            + SNAPSHOT_STATE.pack(*state.engaged, bytes(state.upcolor), bytes(state.downcolor))
+            + SNAPSHOT_PRESETS.pack(present, *masks))
+
+
+def decode(data):
+    """(StopState, registrations) à partir d'un instantané, ValueError s'il est invalide"""
+    size = SNAPSHOT_HEADER.size + SNAPSHOT_STATE.size + SNAPSHOT_PRESETS.size
+    if len(data) != size:
+        raise ValueError("taille %d au lieu de %d" % (len(data), size))
+    magic, version = SNAPSHOT_HEADER.unpack_from(data, 0)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+        raise ValueError("signature ou version inconnue")
+    values = SNAPSHOT_STATE.unpack_from(data, SNAPSHOT_HEADER.size)
+    state = StopState(values[:8], values[8], values[9])
+    values = SNAPSHOT_PRESETS.unpack_from(data, SNAPSHOT_HEADER.size + SNAPSHOT_STATE.size)
+    present = values[0]
+    presets = [list(values[1 + 8 * n:9 + 8 * n]) if present >> n & 1 else None for n in range(len(LP_TOP_ROW))]
+    return state, presets
+
+
+class SnapshotFile(object):
+    """Fichier d'instantané, réécrit seulement quand l'état a changé"""
+    def __init__(self, filename):
+        self.filename = filename
+        self.last = None
+        self.saves = 0
+
+    def load(self):
+        """(StopState, registrations), ou None si le fichier est absent ou invalide"""
+        try:
+            with open(self.filename, 'rb') as f:
+                data = f.read()
+            snapshot = decode(data)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.warning("Instantané %s ignoré: %s", self.filename, e)
+            return None
+        self.last = data
+        return snapshot
+
+    def save(self, data):
+        if data == self.last:
+            return
+        # Remplacement atomique: un arrêt brutal laisse l'ancien instantané intact
+        tmp = self.filename + '.tmp'
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, self.filename)
+        except OSError as e:
+            logging.error("Echec d'écriture de l'instantané %s: %s", self.filename, e)
+            return
+        self.last = data
+        self.saves += 1